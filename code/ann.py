@@ -0,0 +1,121 @@
+'''
+Approximate nearest neighbor search over the repository README vectors.
+
+The index is an inverted file (IVF): the L2-normalized README vectors are
+clustered with spherical k-means, and each repository is listed under its
+nearest centroid. A query only scores the repositories listed under the
+`n_probe` centroids nearest to the query vector, so its cost depends on the
+size of the lists probed instead of the size of the corpus. Probing more
+lists finds more of the exact nearest neighbors at the cost of latency.
+
+The index is built by `preprocess.py --ann-lists N` and saved with the
+repository README vectors in `data_tok.store`.
+'''
+import numpy as np
+
+from scipy import sparse
+
+import store
+
+
+class ReadmeIndex(object):
+    """
+    An inverted file index of README vectors, see the module docstring.
+
+    Arguments:
+    ==========
+
+    centroids: A dense array of shape (lists, terms) with L2-normalized rows
+    order: Row numbers of the indexed matrix, sorted by list
+    offsets: The rows of list `i` are `order[offsets[i]:offsets[i + 1]]`
+    """
+
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    def arrays(self):
+        """Returns the arrays of the index by name, for `store.save`."""
+        return {
+            'ann_centroids': self.centroids,
+            'ann_order': self.order,
+            'ann_offsets': self.offsets,
+        }
+
+    def candidates(self, vec, n_probe=8):
+        """
+        Returns the sorted row numbers listed under the `n_probe` centroids
+        most similar to `vec`.
+        """
+        n_probe = min(n_probe, len(self.offsets) - 1)
+        similarities = self.centroids.dot(np.asarray(vec, dtype=self.centroids.dtype))
+        lists = np.argpartition(-similarities, n_probe - 1)[:n_probe]
+
+        rows = [self.order[self.offsets[idx]:self.offsets[idx + 1]] for idx in lists]
+        return np.sort(np.concatenate(rows))
+
+
+def build_index(matrix, n_lists=None, n_iter=10, sample=20000, seed=0):
+    """
+    Build a `ReadmeIndex` of the rows of `matrix`.
+
+    Arguments:
+    ==========
+
+    matrix: A scipy.sparse matrix of README vectors with L2-normalized rows
+    n_lists: Number of lists (centroids), by default the square root of the
+             number of rows; at most the number of rows the centroids are
+             computed from
+    n_iter: Number of k-means iterations
+    sample: Number of rows the centroids are computed from; all the rows are
+            then listed under their nearest centroid
+    seed: Seed of the random number generator
+    """
+    matrix = sparse.csr_matrix(matrix)
+    n_rows = matrix.shape[0]
+    n_training = min(sample, n_rows)
+    if n_lists == None:
+        n_lists = int(np.sqrt(n_rows))
+    # Each centroid starts from a different training row
+    n_lists = max(1, min(n_lists, n_training))
+
+    rng = np.random.RandomState(seed)
+    training = matrix[np.sort(rng.choice(n_rows, n_training, replace=False))]
+
+    centroids = training[rng.choice(training.shape[0], n_lists, replace=False)].toarray()
+    for _ in range(n_iter):
+        assignment = np.asarray(training.dot(centroids.T).argmax(axis=1)).ravel()
+        members = sparse.csr_matrix(
+            (np.ones(len(assignment)), (assignment, np.arange(len(assignment)))),
+            shape=(n_lists, training.shape[0]))
+        centroids = np.asarray(members.dot(training).todense())
+
+        # Lists that got no rows start over from a random row
+        empty = np.flatnonzero(np.diff(members.indptr) == 0)
+        if len(empty) > 0:
+            centroids[empty] = training[rng.choice(training.shape[0], len(empty))].toarray()
+
+        norms = np.sqrt((centroids ** 2).sum(axis=1))
+        centroids /= np.where(norms == 0, 1, norms)[:, np.newaxis]
+
+    centroids = centroids.astype(np.float32)
+    assignment = np.asarray(matrix.dot(centroids.T.astype(np.float64)).argmax(axis=1)).ravel()
+
+    order = np.argsort(assignment, kind='mergesort').astype(np.int64)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+
+    return ReadmeIndex(centroids, order, offsets)
+
+
+def load_index(directory):
+    """Load the `ReadmeIndex` saved in a dataset, or None if it has none."""
+    centroids = store.load_array(directory, 'ann_centroids')
+    if centroids is None:
+        return None
+
+    return ReadmeIndex(
+        centroids,
+        store.load_array(directory, 'ann_order'),
+        store.load_array(directory, 'ann_offsets'))
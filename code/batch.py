@@ -0,0 +1,208 @@
+'''
+Precomputes the recommendations of many users at once.
+
+The profiles of a block of users are stacked into users x features matrices
+and scored against the repository matrices with one matrix product per
+feature, instead of one pass over the repositories per user and feature.
+The number of users per block is chosen so that the scores of a block fit
+in the given memory budget.
+
+Usage:
+
+    python code/batch.py [output/<user>.store ...]
+
+Without arguments, the recommendations are computed for every user with a
+`<user>.store` and `<user>_tok.store` in `output`. The top recommendations
+of each user are written to `output/recommendations.jsonl`, one JSON document
+per user.
+'''
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+import store
+
+from helper import get_readme_vec
+from model import RepositoryModel, is_same_model
+from recommend import (
+    combine_top,
+    get_feature_weights,
+    lang_profile,
+    topic_profile
+)
+
+# Arrays with a value per repository and user of a block that are in memory
+# at once: the language, topic and README scores, and the intermediate
+# results of computing them
+SCORES_PER_USER = 8
+
+
+def block_size(n_repos, memory_mb):
+    """Returns the number of users whose scores fit in `memory_mb` megabytes"""
+    return max(1, int(memory_mb * 1024 * 1024 // (n_repos * 8 * SCORES_PER_USER)))
+
+
+def block_scores(users, features, readme_matrix, readme_rows):
+    """
+    Score a block of users against all the repositories.
+
+    Arguments:
+    ==========
+
+    users: A list of (user_data, user_readmes) as returned by `store.load`
+    features: The `RepositoryFeatures` of the repositories
+    readme_matrix: The README vectors of the repositories
+    readme_rows: The row of `readme_matrix` of each repository, -1 if it has
+                 no README, as in `model.RepositoryModel`
+
+    Returns:
+    ========
+
+    Language, topic and README similarities as arrays of shape
+    (repositories, users), the same as `lang_scores`, `topic_scores` and
+    `readme_scores` give for each user.
+    """
+    profiles = [lang_profile(user_data, features) for user_data, _ in users]
+    lang_vecs = np.array([vec for vec, _ in profiles])
+    lang_norms = np.array([norm for _, norm in profiles])
+
+    profiles = [topic_profile(user_data, features) for user_data, _ in users]
+    topic_vecs = np.array([vec for vec, _ in profiles])
+    n_topics = np.array([n for _, n in profiles], dtype=float)
+
+    readme_vecs = np.array([get_readme_vec(user_readmes[0]) for _, user_readmes in users])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Cosine similarity, 0 for repositories without languages
+        dot_products = features.language_matrix.dot(lang_vecs.T)
+        lengths = np.outer(features.language_norms, lang_norms)
+        lang = np.where(lengths == 0, 0, dot_products / lengths)
+
+        # Jaccard similarity of the topics
+        intersect = features.topic_matrix.dot(topic_vecs.T)
+        union = n_topics[np.newaxis, :] + features.topic_sums[:, np.newaxis] - intersect
+        topic = np.where(union - intersect == 0, 0, intersect / union)
+
+    # Cosine similarity of the READMEs, NaN for the repositories without a
+    # README or without any of the terms
+    similarities = readme_matrix.dot(readme_vecs.T)
+    similarities[np.diff(readme_matrix.indptr) == 0] = np.nan
+
+    readme = np.full((len(features.repos), len(users)), np.nan)
+    found = readme_rows >= 0
+    readme[found] = similarities[readme_rows[found]]
+
+    return lang, topic, readme
+
+
+def tok_store(path):
+    """Returns the path of the `<user>_tok.store` of the `<user>.store` at `path`."""
+    return path[:-len('.store')] + '_tok.store'
+
+
+def stale_users(names, model):
+    """
+    Returns the paths of `names` whose README vectors were transformed with
+    another TF-IDF model than the repositories of `model`, and so must be
+    preprocessed again before recommending to them.
+    """
+    return [path for path in names if not is_same_model(tok_store(path), model.readme_model)]
+
+
+def recommend_batch(names, model, k=10, memory_mb=512):
+    """
+    Compute the top `k` recommendations of users, a block of users at a time.
+
+    Arguments:
+    ==========
+
+    names: Paths of the users' `<user>.store`, each with a `<user>_tok.store`
+           next to it
+    model: A `model.RepositoryModel`
+    k: Number of recommendations per user
+    memory_mb: Memory budget for the scores of a block of users
+
+    Yields:
+    =======
+
+    (user, recommendations, total) for each user, as `combine_top` returns them
+
+    Raises ValueError if the README vectors of a user were transformed with
+    another TF-IDF model than the repositories', see `stale_users`.
+    """
+    stale = stale_users(names, model)
+    if len(stale) > 0:
+        raise ValueError('README vectors of another TF-IDF model: {}'.format(', '.join(stale)))
+
+    features = model.repository_features
+    size = block_size(len(features.repos), memory_mb)
+
+    for start in range(0, len(names), size):
+        block = names[start:start + size]
+        users = [(store.load(path), store.load(tok_store(path))) for path in block]
+
+        lang, topic, readme = block_scores(users, features, model.repository_readmes[0], model.readme_rows)
+
+        for idx, (path, (user_data, _)) in enumerate(zip(block, users)):
+            user = os.path.basename(path)[:-len('.store')]
+            recommendations, total = combine_top(
+                features.repos,
+                [lang[:, idx], topic[:, idx], readme[:, idx]],
+                get_feature_weights(user),
+                features.exclude(user_data[1]),
+                k=k)
+            yield user, recommendations, total
+
+
+if __name__ == '__main__':
+
+    print('')
+    print('Batch recommendations')
+    print('=====================\n')
+
+    base = os.path.abspath(os.path.dirname(__file__) + '/../output')
+
+    parser = argparse.ArgumentParser(prog='python batch.py')
+    parser.add_argument('users', nargs='*', metavar='user.store',
+        help='users to recommend to; by default every user in `output`')
+    parser.add_argument('--k', type=int, default=10, help='recommendations per user')
+    parser.add_argument('--memory-mb', type=int, default=512,
+        help='memory budget for the scores of a block of users (default: %(default)s)')
+    parser.add_argument('--output', default=os.path.join(base, 'recommendations.jsonl'))
+    args = parser.parse_args()
+
+    users = args.users
+    if len(users) == 0:
+        users = sorted(path for path in glob.glob(os.path.join(base, '*.store'))
+                       if not path.endswith('_tok.store')
+                       and os.path.basename(path) != 'data.store'
+                       and os.path.exists(tok_store(path)))
+
+    model = RepositoryModel(base)
+
+    # Users preprocessed with an earlier TF-IDF model are left out
+    stale = stale_users(users, model)
+    for path in stale:
+        print('Skipping `{}`, preprocessed with another TF-IDF model; run `preprocess.py {}` again'.format(
+            tok_store(path), path))
+    if len(stale) > 0:
+        print('')
+        users = [path for path in users if path not in stale]
+
+    print('Recommending to {} users, {} at a time\n'.format(
+        len(users), block_size(len(model.repository_features.repos), args.memory_mb)))
+
+    with open(args.output, 'w') as f:
+        for user, recommendations, total in recommend_batch(users, model, k=args.k, memory_mb=args.memory_mb):
+            f.write(json.dumps({
+                'user': user,
+                'total': total,
+                'recommendations': [[repo, float(score)] for repo, score in recommendations.items()],
+            }) + '\n')
+
+    print('Saved recommendations to `{}`\n'.format(args.output))
+    print('All done.')
+    print('')
@@ -0,0 +1,954 @@
+'''
+Benchmarks for the recommender pipeline on synthetic data.
+'''
+import argparse
+import base64
+import random
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from vectorize import vectorize_sparse
+
+
+def synthetic_entries(n, seed=0, n_languages=300, n_topics=5000):
+    """
+    Generate `n` entries resembling the ones retrieved by `data.py`. Each
+    repository has up to 5 languages, up to 8 topics and a short README.
+    """
+    rng = random.Random(seed)
+    languages = ['Language{}'.format(i) for i in range(n_languages)]
+    topics = ['topic-{}'.format(i) for i in range(n_topics)]
+    words = ['word{}'.format(i) for i in range(2000)]
+
+    for i in range(n):
+        readme = ' '.join(rng.choice(words) for _ in range(rng.randint(20, 200)))
+        yield {
+            'owner': 'owner{}'.format(i % 1000),
+            'repo': 'repo{}'.format(i),
+            'languages': {rng.choice(languages): rng.randint(1, 100000) for _ in range(rng.randint(0, 5))},
+            'topics': rng.sample(topics, rng.randint(0, 8)),
+            'readme': {'encoding': 'base64', 'content': base64.b64encode(readme.encode('utf-8')).decode('ascii')},
+            'valid': True,
+        }
+
+
+def synthetic_readme(rng, n_words=2000):
+    """
+    Generate a markdown README with the kinds of content `tokenize` has to
+    deal with: links, badges, code, HTML, nested brackets, e-mail addresses
+    and non-ASCII text. Unbalanced brackets are rare, as in real READMEs.
+    """
+    pieces = [
+        'word', 'Library', 'parser', 'the', 'and', 'data', 'install', 'é', 'naïve', '日本語',
+        '[link](https://github.com/owner/repo)', '![badge](http://img.shields.io/x.svg)',
+        '(http://example.com)', '<img src="logo.png">', '{{ template }}', '[nested [brackets]]',
+        '`code`', '```\npip install x\n```', 'user@example.com', '$ npm install', '#heading',
+        '(see below)', '"quoted"', "it's", '\n', '\r\n', '!important', '; x',
+        'C:\\path', 'a/b/c', 'key: value', '|table|', '*emphasis*',
+    ]
+    strays = [']', ')', '>', '}', '(ht', 'tp)']
+
+    words = [rng.choice(pieces) for _ in range(n_words)]
+    if rng.random() < 0.2:
+        words.insert(rng.randint(0, n_words), rng.choice(strays))
+    return ' '.join(words)
+
+
+def reference_tokenize(line, minlength):
+    """
+    The previous implementation of `preprocess.tokenize`, kept for checking
+    that the current one gives identical output.
+    """
+    if type(line) == str:
+        line = line.replace('\n', '').replace('\r', '').replace('"', '\'').replace('\'', '').replace('`','')
+        line = line.lower()
+
+        patterns = re.compile('^.?http|''^.?git|''.*@.*|''^.?[!;]|''.*[\\\].*|''.*[/].*|''.*[/:|$*#()].*')
+
+        # Remove bracketed parts:
+        for bracket in [('[', ']'), ('<','>'), ('{','}'), ('(http', ')')]:
+            while line.find(bracket[0]) != -1 and line.find(bracket[1]) != -1:
+                if line.find(bracket[0]) > line.find(bracket[1]):
+                    line = line.replace(bracket[0], ' ')
+                    line = line.replace(bracket[1], ' ')
+                else: line = line[:line.index(bracket[0])] + line[line.index(bracket[1])+1:]
+
+        line = ' '.join([word for word in line.split() if not patterns.match(word)])
+
+        keepchars = u' 0123456789abcdefghijklmnopqrstuvwxyz'
+        line = ''.join([ch if (ord(ch) < 128) else ' ' for ch in line])
+        keeper = ' '.join(''.join([ch for ch in line if ch in keepchars]).split()).strip()
+
+        return ' '.join([x for x in keeper.split() if len(x) >= minlength])
+    else: return ''
+
+
+def synthetic_tokens(n, seed=0, n_terms=50000, n_clusters=0):
+    """
+    Generate `n` tokenized READMEs as written by `preprocess.py`, with term
+    frequencies following Zipf's law. With `n_clusters`, each README also
+    belongs to one of that many subjects, and half of its words come from the
+    subject's own vocabulary.
+    """
+    rng = np.random.RandomState(seed)
+    terms = np.array(['term{}'.format(i) for i in range(n_terms)], dtype=object)
+    p = 1.0 / np.arange(1, n_terms + 1)
+    p /= p.sum()
+
+    lengths = rng.randint(20, 300, size=n)
+    words = terms[rng.choice(n_terms, size=lengths.sum(), p=p)]
+
+    if n_clusters > 0:
+        subjects = np.array([['subject{}term{}'.format(c, i) for i in range(200)]
+                             for c in range(n_clusters)], dtype=object)
+        clusters = np.repeat(rng.randint(n_clusters, size=n), lengths)
+        mask = rng.rand(len(words)) < 0.5
+        words[mask] = subjects[clusters[mask], rng.randint(200, size=mask.sum())]
+
+    ends = np.cumsum(lengths)
+    return [' '.join(words[end - length:end]) for end, length in zip(ends, lengths)]
+
+
+def reference_readme_sim(user_vecs, repository_vecs):
+    """
+    The previous implementation of `recommend.recommend_readme`, on dense
+    DataFrames with a row for each README, kept for comparison.
+    """
+    from helper import normalize
+
+    def l2_norm(vec):
+        if vec.size == vec.shape[0]:
+            vec = vec.values.reshape((vec.size,))
+        result = np.sqrt(vec.dot(vec.T))
+        if result.shape == (1,1):
+            return result[0][0]
+        else:
+            return result
+
+    repos_in_common = np.intersect1d(list(repository_vecs.index), list(user_vecs.index))
+    repository_vecs = repository_vecs.drop(repos_in_common, axis='index')
+
+    user_mean_vec = normalize(user_vecs.mean(axis=0))
+    user_mean_vec = user_mean_vec.values.reshape((1, user_mean_vec.size))
+
+    dot_products = repository_vecs.dot(user_mean_vec.T)
+    dot_products = dot_products.values.reshape((dot_products.size))
+    lengths = (l2_norm(user_mean_vec) * repository_vecs.apply(l2_norm, axis=1))
+
+    return dot_products / lengths
+
+
+def reference_reshape(user_data, repo_data):
+    """
+    The previous `recommend.reshape`, used by `reference_recommend_lang`.
+    Collapses user_data to one binary vector of languages and topics, and
+    gives user_data and repo_data the same features.
+    """
+    if type(user_data) != pd.DataFrame and type(repo_data) != pd.DataFrame:
+        raise TypeError("user_data and repo_data must be Pandas DataFrames.")
+
+    if "readme" in user_data.index:
+        user_data = user_data.drop("readme", axis="index")
+
+    if "readme" in repo_data.index:
+        repo_data = repo_data.drop("readme", axis="index")
+
+    # Remove NA-values
+    user_data = user_data.fillna(0)
+    repo_data = repo_data.fillna(0)
+
+    # Collapse user_data to sum of languages and topics and convert to int
+    user_data = user_data.sum(axis=1)
+    user_data = user_data.astype(float).astype(int)
+
+    # Binarize user_data and repo_data
+    user_data[user_data != 0] = 1
+    repo_data[repo_data != 0] = 1
+
+    # Rename, so we can access it via column name
+    user_data = user_data.rename('User')
+
+    repo_data = pd.concat([repo_data, user_data], axis=1).fillna(0)
+    user_data = repo_data.loc[:, 'User'].astype(int)
+
+    repo_data = repo_data.drop('User', axis=1)
+    repo_data = repo_data.astype(float).astype(int)
+
+    return user_data, repo_data
+
+
+def reference_combine_scores(features, feature_weights):
+    """
+    The previous `recommend.combine_scores`, sorting all of the scores of a
+    DataFrame with a column per feature, kept for comparison with
+    `recommend.combine_top`.
+    """
+    from helper import normalize
+
+    final_scores = features.dot(feature_weights)
+    final_scores = pd.Series(np.array(final_scores.values.reshape(final_scores.size,)))
+    final_scores.index = features.index
+    final_scores = normalize(final_scores.sort_values(ascending=False))
+
+    return final_scores
+
+
+def reference_recommend_lang(user_data, repository_data):
+    """
+    The previous implementation of `recommend.recommend_lang`, on the
+    DataFrames returned by `store.load_frame`, kept for comparison.
+    """
+    from sklearn.metrics import pairwise_distances
+
+    repository_data = repository_data.drop(
+        np.intersect1d(repository_data.columns, user_data.columns), axis='columns')
+    user_data, repository_data = reference_reshape(user_data, repository_data)
+    user_data = user_data.loc[user_data.index.str.startswith('l_')]
+    repository_data = repository_data.loc[repository_data.index.str.startswith('l_')]
+
+    user_data = user_data - user_data.mean()
+    lang_similarities = 1 - pairwise_distances(
+        repository_data.T, user_data.values.reshape(1, -1), metric='cosine', n_jobs=1)
+    return pd.Series(lang_similarities.flatten(), index=repository_data.columns)
+
+
+def reference_jaccard(repo_topics, user_topics):
+    """The previous `helper.jaccard`, used by `reference_recommend_topic`."""
+    intersect = user_topics[repo_topics != 0].sum()
+    union = user_topics.sum() + repo_topics.sum() - intersect
+    # If no topics marked for either, union and intersect will both be zero:
+    if union - intersect == 0:
+        return 0
+    else:
+        return intersect / float(union)
+
+
+def reference_langs_topics(user_data, repository_data):
+    """
+    The previous `helper.get_langs_topics`, used by `reference_recommend_topic`.
+    Creates DataFrames for user and repository languages and topics.
+    """
+    username = user_data.columns[0].split('/')[0]
+
+    # Count how many repositories user has in each of the languages and topics:
+    counts = user_data.agg(func="sum", axis=1)
+    user_langs = pd.DataFrame(counts[counts.index.str.startswith("l_")], columns=[username])
+    user_topics = pd.DataFrame(counts[counts.index.str.startswith("t_")], columns=[username])
+
+    # Get repo languages and topics
+    repo_langs = repository_data[repository_data.index.str.startswith('l_')]
+    repo_topics = repository_data[repository_data.index.str.startswith('t_')]
+
+    # Binarize user topics
+    user_topics[user_topics > 0] = 1
+
+    # Make user and repository vector lengths equal
+    repo_langs = pd.concat([user_langs, repo_langs], axis=1).fillna(0)
+    user_langs = repo_langs[username]
+    repo_langs = repo_langs.drop([username], axis='columns')
+    repo_topics = pd.concat([user_topics, repo_topics], axis=1).fillna(0)
+    user_topics = repo_topics[username]
+    repo_topics = repo_topics.drop([username], axis='columns')
+
+    return (user_langs, user_topics, repo_langs, repo_topics)
+
+
+def reference_recommend_topic(user_data, repository_data):
+    """
+    The previous implementation of `recommend.recommend_topic`, on the
+    DataFrames returned by `store.load_frame`, kept for comparison.
+    """
+    user_data = user_data.drop(['readme']).fillna(0).astype('float')
+    repository_data = repository_data.drop(['readme']).fillna(0).astype('float')
+    repository_data = repository_data.drop(
+        np.intersect1d(repository_data.columns, user_data.columns), axis='columns')
+
+    user_langs, user_topics, repo_langs, repo_topics = reference_langs_topics(user_data, repository_data)
+    return repo_topics.apply(reference_jaccard, user_topics=user_topics, axis=0)
+
+
+def synthetic_users(n, user_repos, readmes, feature_names, idf):
+    """
+    Generate `n` users with `user_repos` repositories each, as (user_data,
+    user_readmes) like `store.load` returns them, with READMEs from `readmes`
+    transformed with the repository TF-IDF model.
+    """
+    from preprocess import transform_tfidf
+
+    users = []
+    for q in range(n):
+        entries = list(synthetic_entries(user_repos, seed=100 + q, n_languages=50, n_topics=200))
+        for entry in entries:
+            entry['owner'] = 'user{}'.format(q)
+        user_readmes = transform_tfidf(readmes[q * user_repos:(q + 1) * user_repos], feature_names, idf)
+        users.append((vectorize_sparse(entries)[:3], (user_readmes,)))
+    return users
+
+
+def synthetic_github(n, user, seed=0):
+    """
+    Generate the Github REST API responses for a user with `n` repositories
+    of `synthetic_entries`, split over the user's own, watched and starred
+    repositories. A few of them have another license, no license or no
+    README. Returns the responses by path.
+    """
+    rng = random.Random(seed)
+    listings = {'repos': [], 'watched': [], 'starred': []}
+    responses = {}
+
+    for i, entry in enumerate(synthetic_entries(n, seed=seed, n_languages=50, n_topics=200)):
+        owner, name = (user if i % 3 == 0 else entry['owner']), entry['repo']
+        path = '/repos/{}/{}'.format(owner, name)
+
+        listings[['repos', 'watched', 'starred'][i % 3]].append({
+            'owner': {'login': owner},
+            'name': name,
+            'fork': rng.random() < 0.2,
+            'pushed_at': '2018-01-{:02d}T00:00:00Z'.format(1 + i % 28),
+            'updated_at': '2018-02-{:02d}T00:00:00Z'.format(1 + i % 28),
+        })
+
+        key = 'mit' if i % 10 != 7 else 'gpl-3.0'
+        if i % 15 != 4:
+            responses[path + '/license'] = {
+                'encoding': 'base64',
+                'content': base64.b64encode(b'License text').decode('ascii'),
+                'license': {
+                    'key': key,
+                    'name': key.upper() + ' License',
+                    'spdx_id': key.upper(),
+                    'url': 'https://api.github.com/licenses/{}'.format(key),
+                    'node_id': 'L{}'.format(key)}}
+        if i % 12 != 5:
+            responses[path + '/readme'] = entry['readme']
+        responses[path + '/topics'] = {'names': entry['topics']}
+        responses[path + '/languages'] = entry['languages']
+        responses[path + '/contributors'] = [{'login': owner}, {'login': 'other{}'.format(i)}]
+
+    for listing, repos in listings.items():
+        responses['/users/{}/{}'.format(user, listing)] = repos
+    responses['/users/{}'.format(user)] = {'login': user}
+    responses['/rate_limit'] = {'rate': {'limit': 5000, 'remaining': 5000}}
+
+    return responses
+
+
+def replay_graphql(responses, query):
+    """
+    Answer a query of `graphql.build_query` from the REST `responses` of
+    `synthetic_github`, as the GraphQL API would answer it for the same
+    repositories. Repositories without any responses are null.
+    """
+    import json
+
+    data = {}
+    for alias, owner, name in re.findall(r'(r\d+): repository\(owner: ("[^"]*"), name: ("[^"]*")\)', query):
+        path = '/repos/{}/{}'.format(json.loads(owner), json.loads(name))
+        if path + '/topics' not in responses:
+            data[alias] = None
+            continue
+
+        license = responses.get(path + '/license')
+        readme = responses.get(path + '/readme')
+        node = {
+            'licenseInfo': None if license == None else {
+                'key': license['license']['key'],
+                'name': license['license']['name'],
+                'spdxId': license['license']['spdx_id'],
+                'id': license['license']['node_id']},
+            'repositoryTopics': {'nodes': [{'topic': {'name': topic}}
+                                           for topic in responses[path + '/topics']['names']]},
+            'languages': {'edges': [{'size': size, 'node': {'name': language}}
+                                    for language, size in responses[path + '/languages'].items()]},
+        }
+        # The README is found as the first of the README file names
+        node['readme0'] = None if readme == None else {
+            'text': base64.b64decode(readme['content']).decode('utf-8')}
+        data[alias] = node
+
+    return {'data': data}
+
+
+def mock_github(responses, delay):
+    """
+    Start a local HTTP server answering GET requests of the paths of
+    `responses` with their JSON, and others with 404 Not Found, each after
+    `delay` seconds. POST requests to `/graphql` are answered from the same
+    responses with `replay_graphql`. Returns the server and its URL; stop it
+    with `server.shutdown()`.
+    """
+    import json
+    import socketserver
+    import threading
+
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(delay)
+            path = self.path.split('?')[0]
+            if path in responses:
+                self.reply(200, responses[path])
+            else:
+                self.reply(404, {'message': 'Not Found'})
+
+        def do_POST(self):
+            time.sleep(delay)
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            if self.path == '/graphql':
+                self.reply(200, replay_graphql(responses, request['query']))
+            else:
+                self.reply(404, {'message': 'Not Found'})
+
+        def reply(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_vectorize(args):
+    print('{:>8} {:>10} {:>12}'.format('repos', 'seconds', 'us/repo'))
+    for n in args.sizes:
+        entries = list(synthetic_entries(n))
+        (matrix, _, _, _), seconds = timed(vectorize_sparse, entries)
+        print('{:>8} {:>10.3f} {:>12.1f}'.format(n, seconds, 1e6 * seconds / n))
+
+
+def bench_tokenize(args):
+    from preprocess import tokenize
+
+    rng = random.Random(0)
+    corpus = [synthetic_readme(rng, rng.randint(50, args.words)) for _ in range(args.readmes)]
+    megabytes = sum(len(readme.encode('utf-8')) for readme in corpus) / 1e6
+
+    current, seconds = timed(lambda: [tokenize(readme, 3) for readme in corpus])
+    print('tokenize:           {:>8.2f} MB/s'.format(megabytes / seconds))
+
+    if not args.skip_reference:
+        reference, seconds = timed(lambda: [reference_tokenize(readme, 3) for readme in corpus])
+        print('reference_tokenize: {:>8.2f} MB/s'.format(megabytes / seconds))
+        print('')
+        print('Identical output for {} of {} READMEs ({:.1f} MB)'.format(
+            sum(a == b for a, b in zip(current, reference)), len(corpus), megabytes))
+
+
+def bench_readme(args):
+    from preprocess import fit_tfidf, transform_tfidf
+    from recommend import recommend_readme
+
+    print('{:>8} {:>9} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'repos', 'features', 'fit (s)', 'sparse MB', 'dense MB', 'request ms', 'dense ms'))
+
+    for n in args.sizes:
+        readmes = synthetic_tokens(n + args.user_repos)
+        repos = np.array(['owner/repo{}'.format(i) for i in range(n)], dtype=object)
+        users = np.array(['user/repo{}'.format(i) for i in range(args.user_repos)], dtype=object)
+
+        (matrix, feature_names, idf), fit_seconds = timed(fit_tfidf, readmes[:n], args.max_features)
+        user_matrix = transform_tfidf(readmes[n:], feature_names, idf)
+
+        sparse_mb = (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes) / 1e6
+        dense_mb = matrix.shape[0] * matrix.shape[1] * 8 / 1e6
+
+        request_seconds = min(timed(recommend_readme, (user_matrix, users), (matrix, repos))[1]
+                              for _ in range(args.repeat))
+
+        dense_ms = 'skipped'
+        if dense_mb <= args.dense_limit:
+            repository_vecs = pd.DataFrame(matrix.toarray(), index=repos, columns=feature_names)
+            user_vecs = pd.DataFrame(user_matrix.toarray(), index=users, columns=feature_names)
+            dense_seconds = min(timed(reference_readme_sim, user_vecs, repository_vecs)[1]
+                                for _ in range(args.repeat))
+            dense_ms = '{:.1f}'.format(1e3 * dense_seconds)
+
+        print('{:>8} {:>9} {:>10.2f} {:>10.1f} {:>10.1f} {:>12.1f} {:>12}'.format(
+            n, matrix.shape[1], fit_seconds, sparse_mb, dense_mb, 1e3 * request_seconds, dense_ms))
+
+
+def bench_request(args):
+    from recommend import (
+        RepositoryFeatures,
+        combine_top,
+        get_feature_weights,
+        recommend_lang,
+        recommend_topic
+    )
+    from store import to_frame
+
+    print('{:>8} {:>10} {:>9} {:>9} {:>9} {:>12} {:>12} {:>12} {:>10} {:>10} {:>10}'.format(
+        'repos', 'prepare s', 'lang ms', 'topic ms', 'fuse ms', 'old lang ms', 'old topic ms', 'old fuse ms',
+        'lang diff', 'topic diff', 'fuse diff'))
+
+    def max_diff(found, expected):
+        # The largest difference of the scores of the same repositories
+        if set(found.index) != set(expected.index):
+            return 'DIFFERENT'
+        return '{:.1e}'.format(np.nanmax(np.abs(found.reindex(expected.index).values - expected.values)))
+
+    user_entries = list(synthetic_entries(args.user_repos, seed=1, n_languages=50, n_topics=200))
+    for entry in user_entries:
+        entry['owner'] = 'user'
+    user_data = vectorize_sparse(user_entries)
+    weights = get_feature_weights('user')
+
+    for n in args.sizes:
+        repository_data = vectorize_sparse(synthetic_entries(n, n_languages=50, n_topics=200))
+        features, prepare_seconds = timed(RepositoryFeatures, repository_data[:3])
+
+        lang_seconds = min(timed(recommend_lang, user_data[:3], features)[1] for _ in range(args.repeat))
+        topic_seconds = min(timed(recommend_topic, user_data[:3], features)[1] for _ in range(args.repeat))
+        lang, topic = recommend_lang(user_data[:3], features), recommend_topic(user_data[:3], features)
+
+        # Fusing scores of three features; the README scores are random here
+        rng = np.random.RandomState(0)
+        scores = [rng.rand(n) for _ in range(3)]
+        keep = features.exclude(user_data[1])
+        fuse_seconds = min(timed(combine_top, features.repos, scores, weights, keep)[1] for _ in range(args.repeat))
+        frame = pd.concat([pd.Series(values[keep], index=features.repos[keep]) for values in scores], axis=1)
+        old_fuse_seconds = min(timed(lambda: reference_combine_scores(frame, weights).head(10))[1] for _ in range(args.repeat))
+        fuse_diff = max_diff(combine_top(features.repos, scores, weights, keep)[0],
+                             reference_combine_scores(frame, weights).head(10))
+
+        old_lang, old_topic, lang_diff, topic_diff = 'skipped', 'skipped', 'skipped', 'skipped'
+        if n <= args.reference_limit:
+            user_frame, repository_frame = to_frame(*user_data), to_frame(*repository_data)
+            expected, seconds = timed(reference_recommend_lang, user_frame, repository_frame)
+            old_lang, lang_diff = '{:.1f}'.format(1e3 * seconds), max_diff(lang, expected)
+            expected, seconds = timed(reference_recommend_topic, user_frame, repository_frame)
+            old_topic, topic_diff = '{:.1f}'.format(1e3 * seconds), max_diff(topic, expected)
+
+        print('{:>8} {:>10.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>12} {:>12} {:>12.2f} {:>10} {:>10} {:>10}'.format(
+            n, prepare_seconds, 1e3 * lang_seconds, 1e3 * topic_seconds, 1e3 * fuse_seconds,
+            old_lang, old_topic, 1e3 * old_fuse_seconds, lang_diff, topic_diff, fuse_diff))
+
+
+def bench_candidates(args):
+    from recommend import (
+        RepositoryFeatures,
+        candidate_rows,
+        combine_top,
+        get_feature_weights,
+        lang_scores,
+        topic_scores
+    )
+    from vectorize import inverted_index
+
+    weights = get_feature_weights('user')[:2]
+    users = []
+    for q in range(args.users):
+        entries = list(synthetic_entries(args.user_repos, seed=100 + q))
+        for entry in entries:
+            entry['owner'] = 'user{}'.format(q)
+        users.append(vectorize_sparse(entries)[:3])
+
+    def request(user_data, features, min_candidates):
+        rows = candidate_rows(user_data, features, min_candidates=min_candidates)
+        scores = [lang_scores(user_data, features, rows), topic_scores(user_data, features, rows)]
+        return combine_top(features.repos[rows], scores, weights, features.exclude(user_data[1])[rows])
+
+    print('{:>8} {:>11} {:>9} {:>9} {:>9} {:>9}'.format(
+        'repos', 'candidates', 'p50 ms', 'p99 ms', 'all p50', 'all p99'))
+
+    for n in args.sizes:
+        matrix, repos, feature_names, _ = vectorize_sparse(synthetic_entries(n))
+        features = RepositoryFeatures((matrix, repos, feature_names), inverted_index(matrix))
+
+        results = []
+        for min_candidates in (args.min_candidates, n + 1):
+            seconds = [timed(request, user_data, features, min_candidates)[1] for user_data in users]
+            results.append(np.percentile(seconds, [50, 99]) * 1e3)
+        candidates = np.mean([len(candidate_rows(u, features, min_candidates=args.min_candidates)) for u in users])
+
+        print('{:>8} {:>11.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            n, candidates, results[0][0], results[0][1], results[1][0], results[1][1]))
+
+
+def bench_ann(args):
+    from ann import build_index
+    from preprocess import fit_tfidf, transform_tfidf
+    from recommend import recommend_readme
+
+    for n in args.sizes:
+        readmes = synthetic_tokens(n + args.queries * args.user_repos, n_clusters=args.clusters)
+        repos = np.array(['owner/repo{}'.format(i) for i in range(n)], dtype=object)
+        matrix, feature_names, idf = fit_tfidf(readmes[:n], args.max_features)
+
+        users = []
+        for q in range(args.queries):
+            start = n + q * args.user_repos
+            user_matrix = transform_tfidf(readmes[start:start + args.user_repos], feature_names, idf)
+            users.append((user_matrix, np.array(['user{}/repo{}'.format(q, i) for i in range(args.user_repos)], dtype=object)))
+
+        index, build_seconds = timed(build_index, matrix, n_lists=args.lists)
+        print('{} repositories, {} lists, built in {:.1f} s'.format(n, len(index.offsets) - 1, build_seconds))
+        print('{:>8} {:>11} {:>10} {:>11}'.format('n_probe', 'candidates', 'recall@{}'.format(args.k), 'ms/query'))
+
+        exact, seconds = timed(lambda: [recommend_readme(user, (matrix, repos)).nlargest(args.k) for user in users])
+        print('{:>8} {:>11} {:>10.3f} {:>11.2f}'.format('exact', n, 1.0, 1e3 * seconds / len(users)))
+
+        for n_probe in args.probes:
+            found, seconds = timed(lambda: [recommend_readme(user, (matrix, repos), index=index, n_probe=n_probe)
+                                            for user in users])
+            recall = np.mean([len(set(f.nlargest(args.k).index) & set(e.index)) / float(len(e))
+                              for f, e in zip(found, exact)])
+            candidates = np.mean([len(f) for f in found])
+            print('{:>8} {:>11.0f} {:>10.3f} {:>11.2f}'.format(n_probe, candidates, recall, 1e3 * seconds / len(users)))
+        print('')
+
+
+def bench_batch(args):
+    from batch import block_scores
+    from preprocess import fit_tfidf
+    from recommend import (
+        RepositoryFeatures,
+        combine_top,
+        get_feature_weights,
+        lang_scores,
+        readme_scores,
+        topic_scores
+    )
+
+    weights = get_feature_weights('user')
+    n = args.repos
+    readmes = synthetic_tokens(n + args.users * args.user_repos, n_terms=5000)
+    readme_matrix, feature_names, idf = fit_tfidf(readmes[:n], args.max_features)
+    readme_rows = np.arange(n)
+
+    matrix, repos, names, _ = vectorize_sparse(synthetic_entries(n, n_languages=50, n_topics=200))
+    features = RepositoryFeatures((matrix, repos, names))
+
+    users = synthetic_users(args.users, args.user_repos, readmes[n:], feature_names, idf)
+
+    def single():
+        for user_data, user_readmes in users:
+            scores = [lang_scores(user_data, features), topic_scores(user_data, features),
+                      readme_scores(user_readmes, (readme_matrix,))]
+            combine_top(features.repos, scores, weights, features.exclude(user_data[1]))
+
+    def batch(size):
+        for start in range(0, len(users), size):
+            block = users[start:start + size]
+            lang, topic, readme = block_scores(block, features, readme_matrix, readme_rows)
+            for idx, (user_data, _) in enumerate(block):
+                combine_top(features.repos, [lang[:, idx], topic[:, idx], readme[:, idx]],
+                            weights, features.exclude(user_data[1]))
+
+    print('{} repositories, {} users'.format(n, len(users)))
+    print('{:>8} {:>10} {:>10}'.format('block', 'seconds', 'ms/user'))
+    seconds = timed(single)[1]
+    print('{:>8} {:>10.2f} {:>10.2f}'.format('single', seconds, 1e3 * seconds / len(users)))
+    for size in args.blocks:
+        seconds = timed(batch, size)[1]
+        print('{:>8} {:>10.2f} {:>10.2f}'.format(size, seconds, 1e3 * seconds / len(users)))
+
+
+def bench_shards(args):
+    import os
+    import shutil
+    import tempfile
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    import store
+
+    from model import RepositoryModel
+    from preprocess import fit_tfidf
+    from recommend import (
+        candidate_rows,
+        candidate_scores,
+        combine_top,
+        get_feature_weights
+    )
+    from shard import ShardPool, split
+    from vectorize import inverted_index
+
+    weights = get_feature_weights('user')
+    n = args.repos
+    directory = tempfile.mkdtemp()
+
+    try:
+        matrix, repos, names, _ = vectorize_sparse(synthetic_entries(n, n_languages=50, n_topics=200))
+        store.save(os.path.join(directory, 'data.store'), matrix, repos, names, arrays=inverted_index(matrix))
+        readmes = synthetic_tokens(n + args.users * args.user_repos, n_terms=5000)
+        readme_matrix, feature_names, idf = fit_tfidf(readmes[:n], args.max_features)
+        store.save(os.path.join(directory, 'data_tok.store'), readme_matrix, repos, feature_names)
+        users = synthetic_users(args.users, args.user_repos, readmes[n:], feature_names, idf)
+
+        model = RepositoryModel(directory)
+        features = model.repository_features
+
+        def single(user):
+            user_data, user_readmes = user
+            rows = candidate_rows(user_data, features, min_candidates=args.min_candidates)
+            scores = candidate_scores(model, user_data, user_readmes, rows)
+            return combine_top(features.repos[rows], scores, weights, features.exclude(user_data[1])[rows])
+
+        print('{} repositories, {} users, {} concurrent requests'.format(n, len(users), args.concurrency))
+        print('{:>8} {:>10} {:>10}'.format('shards', 'seconds', 'requests/s'))
+
+        expected, seconds = timed(lambda: [single(user) for user in users])
+        print('{:>8} {:>10.2f} {:>10.1f}'.format('none', seconds, len(users) / seconds))
+
+        for n_shards in args.shards:
+            split(directory, n_shards, os.path.join(directory, 'shards'))
+            pool = ShardPool(os.path.join(directory, 'shards'))
+            try:
+                with ThreadPoolExecutor(args.concurrency) as executor:
+                    found, seconds = timed(lambda: list(executor.map(
+                        lambda user: pool.recommend(user[0], user[1], weights, min_candidates=args.min_candidates), users)))
+            finally:
+                pool.close()
+
+            same = all(list(f[0].index) == list(e[0].index) and f[1] == e[1] for f, e in zip(found, expected))
+            print('{:>8} {:>10.2f} {:>10.1f} {}'.format(
+                n_shards, seconds, len(users) / seconds, 'same' if same else 'DIFFERENT'))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_memory(args):
+    import os
+    import shutil
+    import signal
+    import tempfile
+
+    import store
+
+    from model import RepositoryModel, memory_usage, prepare
+    from preprocess import fit_tfidf
+    from recommend import (
+        combine_top,
+        get_feature_weights,
+        lang_scores,
+        readme_scores,
+        topic_scores
+    )
+    from vectorize import inverted_index
+
+    weights = get_feature_weights('user')
+    n = args.repos
+    directory = tempfile.mkdtemp()
+
+    def serve(model, users):
+        features = model.repository_features
+        for user_data, user_readmes in users:
+            scores = [lang_scores(user_data, features), topic_scores(user_data, features),
+                      readme_scores(user_readmes, model.repository_readmes, rows=model.readme_rows)]
+            combine_top(features.repos, scores, weights, features.exclude(user_data[1]))
+
+    def workers(n_workers, model, users):
+        """Forks workers that load `model` (or the model in `directory`), make requests and wait."""
+        pids, pipes = [], []
+        for _ in range(n_workers):
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read)
+                serve(model or RepositoryModel(directory), users)
+                os.write(write, b'.')
+                signal.pause()
+                os._exit(0)
+            os.close(write)
+            pids.append(pid)
+            pipes.append(read)
+
+        for read in pipes:
+            os.read(read, 1)
+            os.close(read)
+        usage = [memory_usage(pid) for pid in pids]
+
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        return usage
+
+    try:
+        matrix, repos, names, _ = vectorize_sparse(synthetic_entries(n, n_languages=50, n_topics=200))
+        store.save(os.path.join(directory, 'data.store'), matrix, repos, names, arrays=inverted_index(matrix))
+        readmes = synthetic_tokens(n + args.users * args.user_repos, n_terms=5000)
+        readme_matrix, feature_names, idf = fit_tfidf(readmes[:n], args.max_features)
+        store.save(os.path.join(directory, 'data_tok.store'), readme_matrix, repos, feature_names)
+        users = synthetic_users(args.users, args.user_repos, readmes[n:], feature_names, idf)
+        del matrix, repos, names, readmes, readme_matrix
+
+        print('{} repositories; memory per worker in MB'.format(n))
+        print('{:>8} {:>8} {:>9} {:>9} {:>9}'.format('mode', 'workers', 'resident', 'propor.', 'private'))
+
+        # Every worker loads its own copy, then every worker memory-maps the
+        # prepared model, then the workers are forked with the model loaded
+        for mode in ('load', 'mmap', 'preload'):
+            if mode == 'mmap':
+                prepare(directory)
+            model = RepositoryModel(directory) if mode == 'preload' else None
+
+            for n_workers in args.workers:
+                usage = workers(n_workers, model, users)
+                print('{:>8} {:>8} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                    mode, n_workers,
+                    np.mean([u['rss'] for u in usage]) / 1e6,
+                    np.mean([u['pss'] for u in usage]) / 1e6,
+                    np.mean([u['private'] for u in usage]) / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_crawl(args):
+    import os
+    import shutil
+    import tempfile
+
+    from cache import ResponseCache
+
+    server, url = mock_github(synthetic_github(args.repos, 'mock'), args.delay_ms / 1000.0)
+
+    # The helpers read the API URL when imported, and send the token only to
+    # the local server
+    os.environ['GITHUB_API_URL'] = url
+    os.environ['GITHUB_GRAPHQL_URL'] = url + '/graphql'
+    os.environ['GITHUB'] = 'mock'
+    import helper
+    from graphql import process_repos_graphql
+    from helper import get_user_repos, process_repos
+
+    # Keep the responses of the mock server out of the real cache
+    directory = tempfile.mkdtemp()
+    helper.response_cache = ResponseCache(directory)
+
+    try:
+        repos = get_user_repos('mock')
+        print('{} repositories, {:.0f} ms per request'.format(len(repos), args.delay_ms))
+        print('{:>8} {:>10} {:>10}'.format('workers', 'seconds', 'repos/s'))
+
+        expected, seconds = timed(lambda: list(process_repos(repos, 'mock')))
+        print('{:>8} {:>10.2f} {:>10.1f}'.format(1, seconds, len(repos) / seconds))
+
+        for workers in args.workers:
+            found, seconds = timed(lambda: list(process_repos(repos, 'mock', workers)))
+            print('{:>8} {:>10.2f} {:>10.1f} {}'.format(
+                workers, seconds, len(repos) / seconds, 'same' if found == expected else 'DIFFERENT'))
+
+        found, seconds = timed(lambda: list(process_repos_graphql(repos, 'mock', batch_size=args.batch_size)))
+        print('{:>8} {:>10.2f} {:>10.1f} {}'.format(
+            'graphql', seconds, len(repos) / seconds, 'same' if found == expected else 'DIFFERENT'))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+
+    print('')
+    print('Recommender benchmarks')
+    print('======================\n')
+
+    parser = argparse.ArgumentParser(prog='python benchmark.py')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parser_vectorize = subparsers.add_parser('vectorize', help='vectorize_sparse')
+    parser_vectorize.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser_vectorize.set_defaults(run=bench_vectorize)
+
+    parser_tokenize = subparsers.add_parser('tokenize', help='preprocess.tokenize')
+    parser_tokenize.add_argument('--readmes', type=int, default=200)
+    parser_tokenize.add_argument('--words', type=int, default=5000, help='maximum words per README')
+    parser_tokenize.add_argument('--skip-reference', action='store_true',
+        help='do not run the previous implementation')
+    parser_tokenize.set_defaults(run=bench_tokenize)
+
+    parser_readme = subparsers.add_parser('readme', help='preprocess.fit_tfidf and recommend.recommend_readme')
+    parser_readme.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser_readme.add_argument('--max-features', type=int, default=20000)
+    parser_readme.add_argument('--user-repos', type=int, default=20)
+    parser_readme.add_argument('--repeat', type=int, default=5, help='best of this many requests')
+    parser_readme.add_argument('--dense-limit', type=float, default=1000,
+        help='run the previous, dense implementation only up to this many MB')
+    parser_readme.set_defaults(run=bench_readme)
+
+    parser_request = subparsers.add_parser('request', help='recommend_lang, recommend_topic and combine_top')
+    parser_request.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser_request.add_argument('--user-repos', type=int, default=20)
+    parser_request.add_argument('--repeat', type=int, default=5, help='best of this many requests')
+    parser_request.add_argument('--reference-limit', type=int, default=10000,
+        help='run the previous implementations only up to this many repositories')
+    parser_request.set_defaults(run=bench_request)
+
+    parser_candidates = subparsers.add_parser('candidates', help='recommend.candidate_rows')
+    parser_candidates.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser_candidates.add_argument('--users', type=int, default=100)
+    parser_candidates.add_argument('--user-repos', type=int, default=5)
+    parser_candidates.add_argument('--min-candidates', type=int, default=1000)
+    parser_candidates.set_defaults(run=bench_candidates)
+
+    parser_ann = subparsers.add_parser('ann', help='ann.ReadmeIndex recall and latency')
+    parser_ann.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser_ann.add_argument('--lists', type=int, default=None, help='default: square root of the size')
+    parser_ann.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser_ann.add_argument('--k', type=int, default=10)
+    parser_ann.add_argument('--queries', type=int, default=50)
+    parser_ann.add_argument('--user-repos', type=int, default=5)
+    parser_ann.add_argument('--clusters', type=int, default=100, help='subjects of the synthetic READMEs')
+    parser_ann.add_argument('--max-features', type=int, default=20000)
+    parser_ann.set_defaults(run=bench_ann)
+
+    parser_batch = subparsers.add_parser('batch', help='batch.block_scores against single-user requests')
+    parser_batch.add_argument('--repos', type=int, default=20000)
+    parser_batch.add_argument('--users', type=int, default=500)
+    parser_batch.add_argument('--user-repos', type=int, default=5)
+    parser_batch.add_argument('--blocks', type=int, nargs='+', default=[1, 16, 64, 256])
+    parser_batch.add_argument('--max-features', type=int, default=20000)
+    parser_batch.set_defaults(run=bench_batch)
+
+    parser_shards = subparsers.add_parser('shards', help='shard.ShardPool throughput')
+    parser_shards.add_argument('--repos', type=int, default=100000)
+    parser_shards.add_argument('--users', type=int, default=200)
+    parser_shards.add_argument('--user-repos', type=int, default=5)
+    parser_shards.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser_shards.add_argument('--concurrency', type=int, default=8, help='requests made at once')
+    parser_shards.add_argument('--min-candidates', type=int, default=1000)
+    parser_shards.add_argument('--max-features', type=int, default=20000)
+    parser_shards.set_defaults(run=bench_shards)
+
+    parser_memory = subparsers.add_parser('memory', help='memory of workers sharing model.RepositoryModel')
+    parser_memory.add_argument('--repos', type=int, default=100000)
+    parser_memory.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser_memory.add_argument('--users', type=int, default=0, help='requests each worker makes first')
+    parser_memory.add_argument('--user-repos', type=int, default=5)
+    parser_memory.add_argument('--max-features', type=int, default=20000)
+    parser_memory.set_defaults(run=bench_memory)
+
+    parser_crawl = subparsers.add_parser('crawl', help='helper.process_repos and graphql.process_repos_graphql against a local mock Github API')
+    parser_crawl.add_argument('--repos', type=int, default=100)
+    parser_crawl.add_argument('--delay-ms', type=float, default=20, help='delay of every response')
+    parser_crawl.add_argument('--workers', type=int, nargs='+', default=[4, 16])
+    parser_crawl.add_argument('--batch-size', type=int, default=50, help='repositories per GraphQL query')
+    parser_crawl.set_defaults(run=bench_crawl)
+
+    args = parser.parse_args()
+    args.run(args)
+    print('')
@@ -0,0 +1,417 @@
+'''
+Caches for Github API responses, tokenized READMEs and recommendations.
+'''
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+
+class ResponseCache(object):
+    """
+    A persistent cache of Github API responses keyed by URL.
+
+    Every entry keeps the response body together with its `ETag` and
+    `Last-Modified` headers, so that the next request for the same URL can be
+    made conditional. Entries are stored as one JSON file per URL in
+    `directory`. When the total size of the files exceeds `max_bytes`, the
+    least recently used entries are removed.
+
+    Arguments:
+    ==========
+
+    directory: Directory where the cached responses are stored
+    max_bytes: Maximum total size of the cached responses in bytes
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._sizes = None
+        self._total = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _load_index(self):
+        # The index is built lazily, so that merely importing helper does not
+        # touch the file system. Oldest files come first.
+        if self._sizes != None:
+            return
+
+        self._sizes = collections.OrderedDict()
+        if not os.path.isdir(self.directory):
+            return
+
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name[:-len('.json')], stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._sizes[key] = size
+            self._total += size
+
+    def get(self, url):
+        """Returns the cached entry for `url`, or None if there is none."""
+        key = self._key(url)
+
+        with self._lock:
+            self._load_index()
+            if key not in self._sizes:
+                return None
+
+            try:
+                with open(self._path(key)) as f:
+                    entry = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._remove(key)
+                return None
+
+            # Mark as most recently used
+            self._sizes.move_to_end(key)
+            os.utime(self._path(key), None)
+
+        return entry
+
+    def put(self, url, entry):
+        """Stores `entry` (a JSON serializable dict) for `url`."""
+        key = self._key(url)
+        data = json.dumps(entry).encode('utf-8')
+
+        with self._lock:
+            self._load_index()
+
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            # Write to a temporary file first, so that a crash never leaves a
+            # truncated entry behind
+            tmp = self._path(key) + '.tmp.{}.{}'.format(os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+
+            self._total -= self._sizes.pop(key, 0)
+            self._sizes[key] = len(data)
+            self._total += len(data)
+
+            while self._total > self.max_bytes and len(self._sizes) > 1:
+                self._remove(next(iter(self._sizes)))
+                self.evictions += 1
+
+    def count(self, hit):
+        """Counts a cache hit (`hit` is True) or miss."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """Returns a one-line summary of the cache usage."""
+        lookups = self.hits + self.misses
+        return 'Response cache: {} hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+            self.hits, self.misses, self.hits / float(lookups) if lookups else 0.0, self.evictions)
+
+    def _remove(self, key):
+        self._total -= self._sizes.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class TokenCache(object):
+    """
+    A persistent cache of tokenized and POS filtered READMEs, keyed by a hash
+    of the raw README and the preprocessing settings, so that a README is only
+    processed again when it or the settings have changed.
+
+    The cache is a single JSON file, read on the first lookup. `save` writes
+    it back, by default with only the entries looked up since, which drops
+    the READMEs that are no longer in the corpus. Saves are serialized with
+    a lock file next to the cache, so that processes sharing the cache do
+    not overwrite each other's entries.
+
+    Arguments:
+    ==========
+
+    path: The JSON-file of the cache
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = None
+        self._used = {}
+        self._added = {}
+
+    def key(self, readme, settings):
+        """Returns the key of `readme` processed with `settings` (a JSON serializable value)."""
+        return hashlib.sha1(json.dumps([settings, readme]).encode('utf-8')).hexdigest()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _load(self):
+        if self._entries == None:
+            self._entries = self._read()
+
+    def get(self, key):
+        """Returns the cached tokens for `key`, or None if there are none."""
+        self._load()
+        tokens = self._entries.get(key)
+
+        if tokens == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._used[key] = tokens
+        return tokens
+
+    def put(self, key, tokens):
+        """Stores the `tokens` (a string) for `key`."""
+        self._load()
+        self._entries[key] = tokens
+        self._used[key] = tokens
+        self._added[key] = tokens
+
+    def save(self, evict=True):
+        """
+        Writes the cache to the file. With `evict`, only the entries looked
+        up or stored since loading are kept. Without it, the entries stored
+        since loading are added to the file as it is now, and nothing is
+        written if there are none.
+        """
+        self._load()
+        if not evict and len(self._added) == 0:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if evict:
+                entries = self._used
+                self.evictions += len(self._entries) - len(entries)
+            else:
+                entries = self._read()
+                entries.update(self._added)
+
+            tmp = self.path + '.tmp.{}'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+
+        self._entries = dict(entries)
+        self._added = {}
+
+    def stats(self):
+        """Returns a one-line summary of the cache usage."""
+        lookups = self.hits + self.misses
+        return 'Token cache: {} hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+            self.hits, self.misses, self.hits / float(lookups) if lookups else 0.0, self.evictions)
+
+
+class RecommendationCache(object):
+    """
+    A least recently used cache of computed recommendations, kept in memory
+    and optionally also on disk, so that it survives restarts.
+
+    The key of an entry is a hash of the username and the versions of all the
+    files the recommendations were computed from (see `model.data_version`),
+    so entries computed from files that have since changed are never found
+    again; they are evicted as the least recently used ones.
+
+    On disk, the cache is a JSON-file of the entries, and a journal file
+    (`<path>.<pid>`) per process that each new entry is appended to as a
+    line, so processes serving the app side by side do not overwrite each
+    other's entries. The journals are merged into the JSON-file when the
+    cache is loaded, and in the background when a journal gets as long as
+    the cache.
+
+    Arguments:
+    ==========
+
+    max_entries: Maximum number of cached recommendation lists
+    path: The JSON-file of the cache; optional
+    """
+
+    def __init__(self, max_entries=1024, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._journal_lines = 0
+        self._merging = None
+
+        if path != None and max_entries > 0:
+            try:
+                for key, entry in self._merge():
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key)
+            except (IOError, OSError):
+                pass
+            self._evict()
+
+    def key(self, user, versions, settings=None):
+        """Returns the key of the recommendations of `user` computed from `versions` with `settings`."""
+        return hashlib.sha1(json.dumps([user, versions, settings]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached entry for `key`, or None if there is none."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None:
+                self.misses += 1
+                return None
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """Stores `entry` (a JSON serializable value) for `key`."""
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+
+        if self.path != None:
+            self._append(key, entry)
+
+    def _evict(self):
+        while len(self._entries) > max(self.max_entries, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _journals(self):
+        # The journals of all the processes, oldest first
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)
+                 if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        return sorted(paths, key=lambda path: os.stat(path).st_mtime)
+
+    def _append(self, key, entry):
+        line = json.dumps([key, entry]) + '\n'
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Appends of different processes go to different files, and only
+        # wait for a merge in progress
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            with self._lock:
+                with open('{}.{}'.format(self.path, os.getpid()), 'a') as f:
+                    f.write(line)
+                self._journal_lines += 1
+
+                merging = None
+                if self._journal_lines >= self.max_entries and self._merging == None:
+                    merging = self._merging = threading.Thread(target=self._merge_in_background)
+                    merging.daemon = True
+
+        if merging != None:
+            merging.start()
+
+    def _merge_in_background(self):
+        try:
+            self._merge()
+        except (IOError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._journal_lines = 0
+                self._merging = None
+
+    def _merge(self):
+        """
+        Merges the journals into the JSON-file, and returns its entries,
+        oldest first.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            entries = collections.OrderedDict()
+            try:
+                with open(self.path) as f:
+                    entries.update(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+
+            journals = self._journals()
+            for journal in journals:
+                with open(journal) as f:
+                    for line in f:
+                        # A line cut short by a crash is left out
+                        try:
+                            key, entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        entries[key] = entry
+                        entries.move_to_end(key)
+
+            items = list(entries.items())[-self.max_entries:]
+            if len(journals) > 0:
+                tmp = self.path + '.tmp.{}'.format(os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(items, f)
+                os.replace(tmp, self.path)
+
+                for journal in journals:
+                    os.remove(journal)
+
+        return items
+
+    def counters(self):
+        """Returns the numbers of hits, misses and evictions, and the number of entries."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+            }
+
+    def stats(self):
+        """Returns a one-line summary of the cache usage."""
+        lookups = self.hits + self.misses
+        return 'Recommendation cache: {} hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+            self.hits, self.misses, self.hits / float(lookups) if lookups else 0.0, self.evictions)
@@ -1,11 +1,13 @@
 '''
 Github dataset extractor.
 '''
+import argparse
 import json
 import sys
 import os
 
 from helper import (
+    API_URL,
     get_languages,
     get_license,
     get_readme,
@@ -13,19 +15,33 @@ from helper import (
     get_user_repos,
     is_contributor,
     process_repo,
+    process_repos,
     rate_limit,
+    request_stats,
     resolve_url
 )
+from vectorize import count_entries, index_entries
+from graphql import process_repos_graphql
 
 print('')
 print('Github dataset extractor')
 print('========================\n')
 
-if len(sys.argv) != 2:
-    print('Usage:\n\tpython data.py number-of-repositories\n')
-    sys.exit(0)
+parser = argparse.ArgumentParser(prog='python data.py')
+parser.add_argument('limit', type=int, help='number of repositories')
+parser.add_argument('--workers', type=int, default=1,
+    help='number of repositories processed concurrently (default: 1)')
+parser.add_argument('--graphql', action='store_true',
+    help='retrieve repositories in batches with the GraphQL API')
+parser.add_argument('--restart', action='store_true',
+    help='discard the results of a previous run instead of resuming it')
+parser.add_argument('--refresh', action='store_true',
+    help='retrieve again only the repositories changed since the previous run')
+args = parser.parse_args()
 
-limit = int(sys.argv[1])
+process = process_repos_graphql if args.graphql else process_repos
+
+limit = args.limit
 
 rate_limit() # Inform about rate limits
 
@@ -33,52 +49,141 @@ print('')
 print('Repositories are limited to following licenses:\n')
 [print(' - {}'.format(x)) for x in ['BSD 2-clause', 'BSD 3-clause', 'MIT']]
 
+# Get the directory of current script (code/data.py)
+base = os.path.dirname(__file__)
+
+# Create output filenames (absolute paths). Entries are appended to the
+# output file one JSON document per line as soon as they are retrieved, and
+# the checkpoint records the search results page being processed, so that an
+# interrupted run can be resumed.
+to_file = os.path.abspath('{}/../output/{}.jsonl'.format(base, 'data'))
+checkpoint_file = os.path.abspath('{}/../output/{}.checkpoint.json'.format(base, 'data'))
+
+# When refreshing, the previous dataset is kept aside until the refresh is
+# complete, and the changed repositories are listed in the changes file
+previous_file = os.path.abspath('{}/../output/{}.previous.jsonl'.format(base, 'data'))
+changes_file = os.path.abspath('{}/../output/{}.changes.json'.format(base, 'data'))
+
+# Ensure existence of ../output
+if not os.path.exists(os.path.dirname(to_file)):
+    os.mkdir(os.path.dirname(to_file))
+
+url = API_URL + '/search/repositories?q=license:bsd-3-clause+license:bsd-2-clause+license:mit'
+start = 0
+
+if args.refresh:
+    # Start a new refresh, unless resuming an interrupted one
+    if not os.path.exists(previous_file):
+        if not os.path.exists(to_file):
+            print('Nothing to refresh, {} not found.\n'.format(to_file))
+            sys.exit(1)
+        os.replace(to_file, previous_file)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+    previous = index_entries(previous_file)
+
+    def is_unchanged(repo):
+        key = '{}/{}'.format(repo['owner']['login'], repo['name'])
+        return (key in previous
+            and repo.get('pushed_at') != None
+            and previous[key][:2] == (repo.get('pushed_at'), repo.get('updated_at')))
+
+    def refresh(repos, workers):
+        # Reuse the previous entries of unchanged repositories and retrieve
+        # only the others, keeping the order
+        changed = process([repo for repo in repos if not is_unchanged(repo)], workers=workers)
+        with open(previous_file, 'rb') as f:
+            for repo in repos:
+                if is_unchanged(repo):
+                    f.seek(previous['{}/{}'.format(repo['owner']['login'], repo['name'])][2])
+                    yield json.loads(f.readline().decode('utf-8'))
+                else:
+                    yield next(changed)
+
+if args.restart or not os.path.exists(checkpoint_file):
+    open(to_file, 'w').close()
+else:
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    url, start = checkpoint['url'], checkpoint['start']
+
+    # Drop a partially written last line, if any
+    with open(to_file, 'rb+') as f:
+        content = f.read()
+        f.truncate(content.rfind(b'\n') + 1)
+
+n_retrieved = count_entries(to_file)
+
 print('')
+if n_retrieved > 0:
+    print('Resuming with {} repositories already retrieved'.format(n_retrieved))
 print('Extracting data for {} open source repositories'.format(limit))
+print('Saving to {}'.format(to_file))
 print('')
 
-n_retrieved = 0
-retrieved_repositories = []
-
-repos, response = resolve_url(
-    'https://api.github.com/search/repositories?q=license:bsd-3-clause+license:bsd-2-clause+license:mit')
-
-data = []
+repos, response = resolve_url(url)
 repos = repos['items']
 
-while len(repos) > 0:
+with open(to_file, 'a') as f:
 
-    data.append(process_repo(repos.pop()))
+    while len(repos) > 0 and n_retrieved < limit:
 
-    n_retrieved += 1
-    if n_retrieved % 10 == 0:
-        print('{:>4} done'.format(n_retrieved, limit))
+        with open(checkpoint_file, 'w') as c:
+            json.dump({'url': url, 'start': start}, c)
 
-    if n_retrieved == limit:
-        break
+        # Repositories of a page are processed from the last one to the first
+        # one, skipping the ones already retrieved, and only as many of them
+        # as are still needed
+        batch = repos[::-1][n_retrieved - start:][:limit - n_retrieved]
 
-    n = len(repos)
-    if n < 1:
-        next_url = response.links['next']
-        repos, response = resolve_url(next_url['url'])
-        repos = repos['items']
-        
-# Get the directory of current script (code/vectorize.py)
-base = os.path.dirname(__file__)
+        for entry in (refresh if args.refresh else process)(batch, workers=args.workers):
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
 
-# Create output filename (absolute path)
-to_file = os.path.abspath('{}/../output/{}.json'.format(base, 'data'))
+            n_retrieved += 1
+            if n_retrieved % 10 == 0:
+                print('{:>4} done'.format(n_retrieved, limit))
 
-# Ensure existence of ../output 
-if not os.path.exists('./output/'):
-    os.mkdir('./output/')
+        if n_retrieved == limit or 'next' not in response.links:
+            break
 
-print('')
-print('Saving to {}'.format(to_file))
+        url, start = response.links['next']['url'], n_retrieved
+        repos, response = resolve_url(url)
+        repos = repos['items']
 
-with open(to_file, 'w') as f:
-    json.dump(data, f, indent=2)
+# The run is complete, so the next one starts over instead of resuming it
+if os.path.exists(checkpoint_file):
+    os.remove(checkpoint_file)
+
+if args.refresh:
+    current = index_entries(to_file)
+    changes = {
+        'changed': sorted(key for key in current if key not in previous
+            or current[key][0] == None or current[key][:2] != previous[key][:2]),
+        'removed': sorted(key for key in previous if key not in current)}
+
+    # Changes not yet applied by `vectorize.py --changes` are kept, so that
+    # refreshing twice before vectorizing does not lose the first changes
+    if os.path.exists(changes_file):
+        with open(changes_file) as f:
+            pending = json.load(f)
+        changes = {
+            'changed': sorted((set(pending['changed']) - set(changes['removed'])) | set(changes['changed'])),
+            'removed': sorted((set(pending['removed']) | set(changes['removed'])) - set(current))}
+        print('')
+        print('Merged with the changes not yet applied in {}'.format(changes_file))
+
+    with open(changes_file, 'w') as f:
+        json.dump(changes, f, indent=2)
+    os.remove(previous_file)
+
+    print('')
+    print('{} repositories changed or new, {} removed'.format(len(changes['changed']), len(changes['removed'])))
+    print('Changes saved to {}'.format(changes_file))
 
+print('')
+print(request_stats())
 print('')
 print('All done.')
 print('')
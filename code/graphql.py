@@ -0,0 +1,195 @@
+'''
+Batched retrieval of repository metadata with the Github GraphQL API.
+'''
+import base64
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from helper import (
+    is_contributor,
+    process_repo,
+    session,
+    token_scheduler
+)
+
+# Can be pointed to a local endpoint, e.g. one replaying recorded responses
+GRAPHQL_URL = os.getenv("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+
+# GraphQL has no equivalent of GET /repos/:owner/:repo/readme, so the README
+# is looked up from the usual file names in the root of the default branch
+README_NAMES = [
+    "README.md", "README", "README.rst", "README.markdown", "README.txt",
+    "readme.md", "Readme.md", "README.MD",
+]
+
+REPOSITORY_FIELDS = """
+    licenseInfo { key name spdxId id }
+    repositoryTopics(first: 100) { nodes { topic { name } } }
+    languages(first: 100) { edges { size node { name } } }
+""" + "".join("""
+    readme{}: object(expression: {}) {{ ... on Blob {{ text }} }}
+""".format(idx, json.dumps("HEAD:" + name)) for idx, name in enumerate(README_NAMES))
+
+
+def build_query(repos):
+    """
+    Build one GraphQL query retrieving license, README, topics and languages
+    of all `repos`. The repository `i` is aliased as `r<i>`.
+    """
+    parts = []
+    for idx, repo in enumerate(repos):
+        parts.append("r{}: repository(owner: {}, name: {}) {{{}}}".format(
+            idx,
+            json.dumps(repo["owner"]["login"]),
+            json.dumps(repo["name"]),
+            REPOSITORY_FIELDS))
+    return "query {\n" + "\n".join(parts) + "\n}"
+
+
+def resolve_query(query):
+    """
+    Resolves a GraphQL query to JSON-data.
+
+    Uses `GITHUB` environment variable for Github Authorization token(s), see
+    `helper.resolve_url`.
+
+    Arguments:
+    ==========
+
+    query: A GraphQL query
+
+    Returns:
+    ========
+
+    The `data` of the response, or None if the request failed.
+    """
+    token = os.getenv("GITHUB")
+
+    if token == None:
+        print('Environment variable GITHUB not found.\nCreate a personal access token on Github and store it to an environment variable.')
+        return None
+
+    response = token_scheduler(token, "graphql").request(
+        session, "POST", GRAPHQL_URL, {}, json={"query": query})
+
+    if response.status_code != 200:
+        return None
+
+    return json.loads(response.text).get("data")
+
+
+def make_entry(repo, node, user = None):
+    """
+    Convert one repository of a GraphQL response to an entry as returned by
+    `helper.process_repo`.
+
+    Arguments:
+    ==========
+
+    repo: The repository as returned by Github REST API
+    node: The repository as returned by the GraphQL query, None if missing
+    user: Github username, see `helper.process_repo`
+    """
+    licenses = ["mit", "bsd-2-clause", "bsd-3-clause"]
+
+    entry = {}
+    owner, name = repo["owner"]["login"], repo["name"]
+
+    # A repository that cannot be resolved is handled as the REST endpoints
+    # answering 404 would be handled
+    if node == None:
+        node = {"licenseInfo": None, "repositoryTopics": {"nodes": []}, "languages": None}
+
+    license = {}
+    if node["licenseInfo"] != None:
+        info = node["licenseInfo"]
+        license = {
+            "key": info["key"],
+            "name": info["name"],
+            "spdx_id": info["spdxId"],
+            "url": "https://api.github.com/licenses/{}".format(info["key"]),
+            "node_id": info["id"]}
+
+    if "key" in license.keys() and license["key"] not in licenses:
+        entry["owner"] = owner
+        entry["repo"] = name
+        entry["pushed_at"] = repo.get("pushed_at")
+        entry["updated_at"] = repo.get("updated_at")
+        entry["valid"] = False
+        return entry
+
+    readme = {}
+    for idx in range(len(README_NAMES)):
+        blob = node.get("readme{}".format(idx))
+        if blob != None and blob.get("text") != None:
+            readme = {
+                "encoding": "base64",
+                "content": base64.b64encode(blob["text"].encode("utf-8")).decode("ascii")}
+            break
+
+    languages = None
+    if node["languages"] != None:
+        languages = {edge["node"]["name"]: edge["size"] for edge in node["languages"]["edges"]}
+
+    entry["owner"] = owner
+    entry["repo"] = name
+    entry["pushed_at"] = repo.get("pushed_at")
+    entry["updated_at"] = repo.get("updated_at")
+    entry["fork"] = repo["fork"]
+    entry["license"] = license
+    entry["readme"] = readme
+    entry["topics"] = [n["topic"]["name"] for n in node["repositoryTopics"]["nodes"]]
+    entry["languages"] = languages
+
+    # Contributors are not available through GraphQL, but this is only needed
+    # for the user's own repositories
+    if user != None:
+        entry["contributor"] = is_contributor(user, owner, name)
+
+    entry["valid"] = True
+
+    return entry
+
+
+def process_batch(repos, user = None):
+    """
+    Retrieve entries of `repos` with a single GraphQL query. If the query
+    fails, falls back to retrieving them one by one with the REST API.
+    """
+    data = resolve_query(build_query(repos))
+    if data == None:
+        return [process_repo(repo, user) for repo in repos]
+
+    return [make_entry(repo, data.get("r{}".format(idx)), user)
+            for idx, repo in enumerate(repos)]
+
+
+def process_repos_graphql(repos, user = None, workers = 1, batch_size = 50):
+    """
+    Process several repositories like `helper.process_repos`, but retrieve
+    them `batch_size` at a time with the GraphQL API instead of making four
+    to five REST requests per repository. Entries are yielded in the same
+    order as the repositories were given.
+
+    Arguments:
+    ==========
+
+    repos: A list of repositories as returned by Github API
+    user: Github username, see `helper.process_repo`
+    workers: Maximum number of batches processed concurrently
+    batch_size: Number of repositories per query
+    """
+    batches = [repos[i:i + batch_size] for i in range(0, len(repos), batch_size)]
+
+    if workers <= 1:
+        for batch in batches:
+            for entry in process_batch(batch, user):
+                yield entry
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entries in executor.map(lambda batch: process_batch(batch, user), batches):
+            for entry in entries:
+                yield entry
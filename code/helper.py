@@ -4,6 +4,59 @@ import json
 import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from cache import ResponseCache
+from ratelimit import TokenScheduler
+
+# One keep-alive session shared by all requests (and threads), so that
+# connections to Github are reused instead of opened for every request
+session = rq.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# Root of the Github REST API, e.g. a local server for testing
+API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+# Exit status of `user.py` when there is no such Github user
+USER_NOT_FOUND = 3
+
+# Responses are cached on disk and revalidated with conditional requests.
+# Unchanged resources are answered with 304 Not Modified, which does not
+# count against the rate limit.
+response_cache = ResponseCache(
+    os.path.abspath(os.path.dirname(__file__) + '/../output/cache'),
+    max_bytes=int(os.getenv('GITHUB_CACHE_MB', 256)) * 1024 * 1024)
+
+# Schedulers by the value of `GITHUB` and the API resource
+_schedulers = {}
+
+
+def token_scheduler(tokens, resource = "core"):
+    """
+    Returns the request scheduler for `tokens`, a comma-separated list of
+    Github access tokens (the value of the `GITHUB` environment variable).
+
+    Github keeps separate rate limits for each `resource` (e.g. "core" for
+    the REST API and "graphql" for the GraphQL API), so each of them has its
+    own scheduler.
+    """
+    key = (tokens, resource)
+    scheduler = _schedulers.get(key)
+    if scheduler == None:
+        scheduler = _schedulers.setdefault(key, TokenScheduler(
+            [token.strip() for token in tokens.split(",") if token.strip()]))
+    return scheduler
+
+
+def request_stats():
+    """Returns a summary of the response cache and rate limit usage."""
+    lines = [response_cache.stats()]
+    for (_, resource), scheduler in sorted(_schedulers.items()):
+        lines.append("[{}] {}".format(resource, scheduler.status()))
+    return "\n".join(lines)
+
 
 def process_repo(repo, user = None):
 
@@ -23,15 +76,20 @@ def process_repo(repo, user = None):
 
     # The "key" contains license keys specified by Github and we target the ones
     # listed at the beginning of this function. Even if the license is not valid
-    # for us, add few bits of info about the specific repo.
+    # for us, add few bits of info about the specific repo. The timestamps tell
+    # whether the repo has changed when the dataset is refreshed.
     if "key" in license.keys() and license["key"] not in licenses:
         entry["owner"] = owner
         entry["repo"] = name
+        entry["pushed_at"] = repo.get("pushed_at")
+        entry["updated_at"] = repo.get("updated_at")
         entry["valid"] = False
         return entry
     else:
         entry["owner"] = owner
         entry["repo"] = name
+        entry["pushed_at"] = repo.get("pushed_at")
+        entry["updated_at"] = repo.get("updated_at")
         entry["fork"] = repo["fork"]
         entry["license"] = license
         entry["readme"] = get_readme(owner, name)
@@ -50,9 +108,38 @@ def process_repo(repo, user = None):
     return entry
 
 
+def process_repos(repos, user = None, workers = 1):
+    """
+    Process several repositories, yielding the entries in the same order as
+    the repositories were given.
+
+    Nearly all of the time spent in `process_repo` is waiting for Github to
+    respond, so with `workers` > 1 the repositories are processed by a
+    bounded pool of threads. At most `workers` repositories are in flight at
+    any time.
+
+    Arguments:
+    ==========
+
+    repos: A list of repositories as returned by Github API
+    user: Github username, see `process_repo`
+    workers: Maximum number of repositories processed concurrently
+    """
+    if workers <= 1:
+        for repo in repos:
+            yield process_repo(repo, user)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Executor.map submits everything at once, but results come back in
+        # submission order
+        for entry in executor.map(lambda repo: process_repo(repo, user), repos):
+            yield entry
+
+
 def rate_limit():
 
-    rate_limit, _ = resolve_url("https://api.github.com/rate_limit")
+    rate_limit, _ = resolve_url(API_URL + "/rate_limit")
 
     if rate_limit != None:
         try:
@@ -61,7 +148,7 @@ def rate_limit():
                 rate_limit["rate"]["limit"]))
         except: pass
     else:
-        print('Failed to resolve URL https://api.github.com/rate_limit')
+        print('Failed to resolve URL {}/rate_limit'.format(API_URL))
 
 
 
@@ -69,7 +156,15 @@ def resolve_url(url):
     """
     Resolves an URL to JSON-data.
 
-    Uses `GITHUB` environment variable for Github Authorization token.
+    Uses `GITHUB` environment variable for Github Authorization token. It may
+    hold several comma-separated tokens, in which case the requests are
+    spread over them. Requests are paced according to the rate limits and
+    retried when they hit one, see `ratelimit.TokenScheduler`.
+
+    Responses are cached in `output/cache`. If the URL has been resolved
+    before, the request is made conditional on the cached `ETag` and
+    `Last-Modified` headers and the cached data is returned if Github answers
+    304 Not Modified.
 
     Arguments:
     ==========
@@ -79,16 +174,41 @@ def resolve_url(url):
     token = os.getenv("GITHUB")
 
     if token != None:
-        response = rq.get(
-            url=url,
-            headers={
-                "Authorization" : "bearer {}".format(token),
-                "Accept"        : "application/vnd.github.mercy-preview+json"
-            })
+        headers = {
+            "Accept"        : "application/vnd.github.mercy-preview+json"
+        }
+
+        cached = response_cache.get(url)
+        if cached != None:
+            if cached["etag"] != None:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"] != None:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = token_scheduler(token).request(session, "GET", url, headers)
+
+        if response.status_code == 304 and cached != None:
+            response_cache.count(hit=True)
+            # A 304 carries no body and may lack the pagination links
+            for name, value in cached["headers"].items():
+                if name not in response.headers:
+                    response.headers[name] = value
+            return json.loads(cached["body"]), response
+
+        response_cache.count(hit=False)
 
         if response.status_code == 404:
             return None, response
 
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 200 and (etag != None or last_modified != None):
+            response_cache.put(url, {
+                "etag": etag,
+                "last_modified": last_modified,
+                "headers": {k: v for k, v in response.headers.items() if k.lower() == "link"},
+                "body": response.text})
+
         return json.loads(response.text), response
     else:
         print('Environment variable GITHUB not found.\nCreate a personal access token on Github and store it to an environment variable.')
@@ -104,9 +224,9 @@ def get_user_repos(user_id):
     - Repositories user has bookmarked (starred)
     """
     urls = [
-        "https://api.github.com/users/{}/repos".format(user_id),
-        "https://api.github.com/users/{}/watched".format(user_id),
-        "https://api.github.com/users/{}/starred".format(user_id),
+        API_URL + "/users/{}/repos".format(user_id),
+        API_URL + "/users/{}/watched".format(user_id),
+        API_URL + "/users/{}/starred".format(user_id),
         ]
 
     responses = []
@@ -150,7 +270,7 @@ def get_languages(owner, repo):
     Return:
     languages: a dict containing language, loc, pairs; if none, then empty dict
     """
-    uri = "https://api.github.com/repos/{}/{}/languages".format(owner, repo)
+    uri = API_URL + "/repos/{}/{}/languages".format(owner, repo)
     languages, _ = resolve_url(uri)
     return languages
 
@@ -167,7 +287,7 @@ def get_topics(owner, repo):
     owner: Github username
     repo: Repository name
     """
-    uri = "https://api.github.com/repos/{}/{}/topics".format(owner, repo)
+    uri = API_URL + "/repos/{}/{}/topics".format(owner, repo)
     topics, _ = resolve_url(uri)
 
     # Current Github API returns a dict as follows:
@@ -192,7 +312,7 @@ def get_license(owner, repo):
     owner: Github username
     repo: Repository name
     """
-    uri = "https://api.github.com/repos/{}/{}/license".format(owner, repo)
+    uri = API_URL + "/repos/{}/{}/license".format(owner, repo)
     license, _ = resolve_url(uri)
 
     if license == None:
@@ -216,7 +336,7 @@ def get_readme(owner, repo):
     owner: Github username
     repo: Repository name
     """
-    uri = "https://api.github.com/repos/{}/{}/readme".format(owner, repo)
+    uri = API_URL + "/repos/{}/{}/readme".format(owner, repo)
     readme, _ = resolve_url(uri)
 
     if readme == None:
@@ -226,7 +346,7 @@ def get_readme(owner, repo):
 
 
 def is_contributor(user, owner, repo):
-    uri = "https://api.github.com/repos/{}/{}/contributors".format(owner, repo)
+    uri = API_URL + "/repos/{}/{}/contributors".format(owner, repo)
     contributors, _ = resolve_url(uri)
     if contributors == None:
         return False
@@ -250,71 +370,20 @@ def normalize(df):
     return df / float(rng)
 
 
-def normalize_combo_score(df):
-    minimum = 0
-    rng = df.max().max() - minimum
-    if rng == 0:
-        # raise ValueError("helper.normalize: range 0, division by zero")
-        return df
-    df = df - minimum
-    return df / float(rng)
-
-
-def l2_norm(vec):
-    if vec.size == vec.shape[0]:
-        vec = vec.values.reshape((vec.size,))
-    result = np.sqrt(vec.dot(vec.T))
-    if result.shape == (1,1):
-        return result[0][0]
-    else:
-        return result
-
-
-def jaccard(repo_topics, user_topics):
-    intersect = user_topics[repo_topics != 0].sum()
-    union = user_topics.sum() + repo_topics.sum() - intersect
-    # If no topics marked for either, union and intersect will both be zero:
-    if union - intersect == 0:
-        return 0
-    else:
-        return intersect / float(union)
+def get_readme_vec(user_vecs):
+    # Compute an average user README vector to compare against other's repository readmes,
+    # L2-normalized. user_vecs is a sparse matrix with a row for each README
+    user_mean_vec = normalize(np.asarray(user_vecs.mean(axis=0)).ravel())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return user_mean_vec / np.sqrt(user_mean_vec.dot(user_mean_vec))
 
 
 def get_readme_sim(user_vecs, repository_vecs):
-    # Compute an average user README vector to compare against other's repository readmes
-    user_mean_vec = normalize(user_vecs.mean(axis=0))
-    user_mean_vec = user_mean_vec.values.reshape((1, user_mean_vec.size))
-
-    dot_products = repository_vecs.dot(user_mean_vec.T)
-    dot_products = dot_products.values.reshape((dot_products.size))
-    lengths = (l2_norm(user_mean_vec) * repository_vecs.apply(l2_norm, axis=1))
-
-    return dot_products / lengths
-
-
-def get_langs_topics(user_data, repository_data):
-    """ Create dataframes for user/repo languages and topics """
-    username = username = user_data.columns[0].split('/')[0]
-
-    # Count how many repositories user has in each of the languages and topics:
-    counts = user_data.agg(func="sum", axis=1)
-    user_langs = pd.DataFrame(counts[counts.index.str.startswith("l_")], columns=[username])
-    user_topics = pd.DataFrame(counts[counts.index.str.startswith("t_")], columns=[username])
-
-    # Get repo languages and topics
-    repo_langs = repository_data[repository_data.index.str.startswith('l_')]
-    repo_topics = repository_data[repository_data.index.str.startswith('t_')]
-
-    # Binarize user topics
-    user_topics[user_topics > 0] = 1
-
-    # Make user and repository vector lengths equal
-    repo_langs = pd.concat([user_langs, repo_langs], axis=1).fillna(0)
-    user_langs = repo_langs[username]
-    repo_langs = repo_langs.drop([username], axis='columns')
-    repo_topics = pd.concat([user_topics, repo_topics], axis=1).fillna(0)
-    user_topics = repo_topics[username]
-    repo_topics = repo_topics.drop([username], axis='columns')
-
-    return (user_langs, user_topics, repo_langs, repo_topics)
-
+    # Both are sparse matrices with a row for each README, and the rows of
+    # repository_vecs are L2-normalized, so the cosine similarities are one
+    # matrix-vector product
+    similarities = repository_vecs.dot(get_readme_vec(user_vecs))
+
+    # READMEs without any of the terms have no similarity
+    similarities[np.diff(repository_vecs.indptr) == 0] = np.nan
+    return similarities
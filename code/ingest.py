@@ -0,0 +1,254 @@
+'''
+Background ingestion of new users for the web app.
+
+A job fetches the profile of a Github user and prepares it for
+recommendations, the same steps as running the scripts by hand:
+
+    python code/user.py <user>
+    python code/vectorize.py output/<user>.json
+    python code/preprocess.py output/<user>.store
+
+The scripts run as subprocesses of a few background threads, so a request
+only queues the job and returns. The README vectors are transformed with the
+TF-IDF model saved with `data_tok.store`, so the repository data must have
+been preprocessed first.
+'''
+import fcntl
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from helper import USER_NOT_FOUND
+
+# Github usernames: alphanumeric characters or single hyphens, not at the
+# start or the end, at most 39 characters
+USERNAME = re.compile(r'^[A-Za-z0-9](?:[A-Za-z0-9]|-(?=[A-Za-z0-9])){0,38}$')
+
+
+def is_username(user):
+    """Returns whether `user` is a valid Github username, so it is safe to use in file names."""
+    return USERNAME.match(user) != None
+
+
+def is_running(pid):
+    """Returns whether the process `pid` is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class IngestQueue(object):
+    """
+    Runs the ingestion jobs of new users in the background.
+
+    The jobs are shared by all the processes running a queue with the same
+    `root`, e.g. the workers of `web/serve.py`. The status of the job of a
+    user is kept in `output/<user>.ingest`, which is created only if it does
+    not exist yet, and the jobs are submitted holding a lock on
+    `output/ingest.lock`. There is at most one job per user at a time:
+    submitting a user whose job is queued or running in any of the processes
+    returns that job. At most `max_jobs` jobs are queued or running at once;
+    more are refused until some have finished. A failed job is kept for
+    `retry_after` seconds, during which submitting the user again returns it
+    instead of fetching the user again. A job whose process has exited is
+    failed.
+
+    Arguments:
+    ==========
+
+    root: Root directory of the repository, where the scripts are run
+    max_jobs: Maximum number of jobs queued or running at once
+    workers: Number of jobs run at once by this process
+    timeout: Seconds a step of a job may take before it is stopped
+    retry_after: Seconds before a user whose job failed is fetched again
+    """
+
+    def __init__(self, root, max_jobs=4, workers=1, timeout=1800, retry_after=600):
+        self.root = root
+        self.directory = os.path.join(root, 'output')
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def steps(self, user):
+        """Returns the name and command of each step of the job of `user`."""
+        return [
+            ('profile', [sys.executable, 'code/user.py', user]),
+            ('vectorize', [sys.executable, 'code/vectorize.py', 'output/{}.json'.format(user)]),
+            ('preprocess', [sys.executable, 'code/preprocess.py', 'output/{}.store'.format(user)]),
+        ]
+
+    def outputs(self, user):
+        """Returns the file written by each step of the job of `user`, removed if it fails."""
+        return {
+            'profile': os.path.join(self.directory, '{}.json'.format(user)),
+            'vectorize': os.path.join(self.directory, '{}.store'.format(user)),
+            'preprocess': os.path.join(self.directory, '{}_tok.store'.format(user)),
+        }
+
+    def submit(self, user, first_step='profile'):
+        """
+        Queue the job of `user`, unless one is already queued or running, or
+        has failed within `retry_after` seconds.
+
+        The job runs the steps from `first_step` on, e.g. 'preprocess' to only
+        transform the READMEs of a user again after the TF-IDF model of the
+        repositories has changed.
+
+        Returns the status of the job (see `status`), or None if there are
+        already `max_jobs` jobs.
+        """
+        if not is_username(user):
+            raise ValueError('Invalid username: {!r}'.format(user))
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        with open(os.path.join(self.directory, 'ingest.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            job = self.status(user)
+            if job != None:
+                if job['status'] in ('queued', 'running'):
+                    return job
+                if (job['status'] == 'failed' and job['finished_at'] != None
+                        and time.time() - job['finished_at'] < self.retry_after):
+                    return job
+                os.remove(self._path(user))
+
+            counters = self.counters()
+            if counters['queued'] + counters['running'] >= self.max_jobs:
+                return None
+
+            job = {
+                'user': user,
+                'status': 'queued',
+                'first_step': first_step,
+                'step': None,
+                'error': None,
+                'submitted_at': time.time(),
+                'finished_at': None,
+                'pid': os.getpid(),
+            }
+            if not self._write(job, create=True):
+                return self.status(user)
+
+        self._executor.submit(self._run, job)
+        return self._public(job)
+
+    def status(self, user):
+        """
+        Returns the status of the latest job of `user` as a dict: `status` is
+        queued, running, done or failed, `step` the step running or failed,
+        `error` the end of the output of a failed step, and `retry_at` the
+        time from which a failed job is run again when submitted. None if
+        there is no such job.
+        """
+        job = self._read(self._path(user))
+        return self._public(job) if job != None else None
+
+    def counters(self):
+        """Returns the numbers of queued and running jobs of all the processes."""
+        statuses = [job['status'] for job in map(self._read, glob.glob(os.path.join(self.directory, '*.ingest')))
+                    if job != None]
+        return {'queued': statuses.count('queued'), 'running': statuses.count('running')}
+
+    def _path(self, user):
+        return os.path.join(self.directory, '{}.ingest'.format(user))
+
+    def _public(self, job):
+        job = {name: value for name, value in job.items() if name != 'pid'}
+        if job['status'] == 'failed':
+            # Interrupted jobs have no finish time and are run again at once
+            job['retry_at'] = None
+            if job['finished_at'] != None:
+                job['retry_at'] = job['finished_at'] + self.retry_after
+        return job
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                job = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if job['status'] in ('queued', 'running') and not is_running(job['pid']):
+            job.update(status='failed', error='Interrupted')
+        return job
+
+    def _write(self, job, create=False):
+        # The file is written completely before it is put in place, so it is
+        # never read half-written. With `create`, returns False if the file
+        # already exists.
+        path = self._path(job['user'])
+        tmp = '{}.tmp.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+
+        if not create:
+            os.replace(tmp, path)
+            return True
+
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    def _steps(self, job):
+        steps = self.steps(job['user'])
+        first = [step for step, _ in steps].index(job['first_step'])
+        return steps[first:]
+
+    def _run(self, job):
+        self._update(job, status='running')
+
+        try:
+            for step, command in self._steps(job):
+                self._update(job, step=step)
+                process = subprocess.run(
+                    command, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    timeout=self.timeout)
+                if step == 'profile' and process.returncode == USER_NOT_FOUND:
+                    raise RuntimeError('User not found')
+                if process.returncode != 0:
+                    output = process.stdout.decode('utf-8', 'replace').strip().splitlines()
+                    raise RuntimeError('\n'.join(output[-5:]) or 'exit status {}'.format(process.returncode))
+        except subprocess.TimeoutExpired:
+            self._fail(job, 'Timed out after {} seconds'.format(self.timeout))
+        except Exception as e:
+            self._fail(job, str(e))
+        else:
+            self._update(job, status='done', step=None, finished_at=time.time())
+
+    def _update(self, job, **values):
+        job.update(values)
+        self._write(job)
+
+    def _fail(self, job, error):
+        # Remove what the job has written, so that the user is not taken to
+        # exist
+        outputs = self.outputs(job['user'])
+        for path in [outputs[step] for step, _ in self._steps(job)]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        self._update(job, status='failed', error=error, finished_at=time.time())
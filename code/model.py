@@ -0,0 +1,275 @@
+'''
+Repository data loaded once and shared by all recommendation requests.
+
+The repository features and row mappings derived from `data.store` and
+`data_tok.store` can be prepared once and saved to `model.store`:
+
+    python code/model.py
+
+A model then memory-maps them instead of computing them, so that every
+process serving requests shares one copy of them through the page cache.
+`model.store` is only used while it is up to date with the data files;
+otherwise the model is computed from them as before.
+'''
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import store
+
+from ann import load_index
+from recommend import RepositoryFeatures
+
+
+def data_version(paths):
+    """
+    Returns a value that changes whenever any of `paths` is replaced or
+    modified. `store.save` replaces the whole directory, so the inode and
+    modification time of a `.store` directory identify its version.
+    """
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            version.append((path, stat.st_ino, stat.st_mtime_ns))
+        except OSError:
+            version.append((path, None, None))
+    return tuple(version)
+
+
+def load_postings(directory):
+    """
+    Load the inverted index saved by `vectorize.py`, or None if the dataset
+    has none (datasets converted from CSV-files).
+    """
+    indptr = store.load_array(directory, 'postings_indptr')
+    if indptr is None:
+        return None
+    return {'postings_indptr': indptr, 'postings_rows': store.load_array(directory, 'postings_rows')}
+
+
+def load_readme_model(directory):
+    """
+    Returns the fingerprint of the TF-IDF model that the README vectors in
+    `directory` were transformed with (see `preprocess.model_fingerprint`),
+    or None for vectors saved before fingerprints were.
+    """
+    saved = store.load_array(directory, 'model', mmap=False)
+    return None if saved is None else str(saved)
+
+
+def is_same_model(user_readmes, repository_model):
+    """
+    Returns whether the README vectors of a user in `user_readmes` (the
+    path of `<user>_tok.store`) can be compared with those of the
+    repositories, whose fingerprint is `repository_model`. Without a
+    fingerprint of the repositories, there is nothing to check against.
+    """
+    return repository_model == None or load_readme_model(user_readmes) == repository_model
+
+
+def source_version(version):
+    """The part of a `data_version` that does not depend on how the paths are written."""
+    return json.dumps([list(entry[1:]) for entry in version])
+
+
+def load_prepared(directory, version):
+    """
+    Load the arrays saved by `prepare` in `directory`, memory-mapped, by
+    name, or None if there are none or they were prepared from another
+    `version` of the data files.
+    """
+    saved = store.load_array(directory, 'source_version', mmap=False)
+    if saved is None or str(saved) != source_version(version):
+        return None
+
+    names = [name[:-len('.npy')] for name in os.listdir(directory) if name.endswith('.npy')]
+    return {name: store.load_array(directory, name) for name in names}
+
+
+def prepare(base_path):
+    """
+    Save the repository features and row mappings of the data in `base_path`
+    to `model.store`, see the module docstring. Returns the model.
+    """
+    model = RepositoryModel(base_path)
+
+    arrays = model.repository_features.arrays()
+    arrays['repository_rows'] = model.repository_rows
+    arrays['readme_rows'] = model.readme_rows
+    arrays['source_version'] = np.array(source_version(model.version[:2]))
+    store.save_arrays(model.paths[2], arrays)
+
+    return model
+
+
+def memory_usage(pid):
+    """
+    Returns the resident, proportional (shared pages divided among the
+    processes sharing them) and private memory of process `pid` in bytes,
+    from `/proc` (Linux only).
+    """
+    usage = {'Rss': 0, 'Pss': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.exists(path):
+        path = '/proc/{}/smaps'.format(pid)
+
+    with open(path) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in usage:
+                usage[name] += int(value.split()[0]) * 1024
+
+    return {
+        'rss': usage['Rss'],
+        'pss': usage['Pss'],
+        'private': usage['Private_Clean'] + usage['Private_Dirty'],
+    }
+
+
+class RepositoryModel(object):
+    """
+    The repository datasets needed for making recommendations, loaded from
+    `base_path` (the `output` directory).
+
+    A model is never modified after it has been loaded; a new version of the
+    data is loaded into a new model.
+    """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.paths = [
+            os.path.join(base_path, 'data.store'),
+            os.path.join(base_path, 'data_tok.store'),
+            os.path.join(base_path, 'model.store'),
+        ]
+        self.version = data_version(self.paths)
+
+        # The features and row mappings saved by `prepare`, if up to date
+        prepared = load_prepared(self.paths[2], self.version[:2])
+
+        # The language and topic features of the repositories prepared for
+        # scoring, and the preprocessed README-values as a sparse matrix with
+        # a row for each repository, with the repository and term names
+        if prepared != None:
+            self.repository_features = RepositoryFeatures.from_arrays(prepared)
+        else:
+            self.repository_features = RepositoryFeatures(store.load(self.paths[0]), load_postings(self.paths[0]))
+        self.repository_readmes = store.load(self.paths[1])
+        self.readme_model = load_readme_model(self.paths[1])
+
+        # The approximate nearest neighbor index of the READMEs, if one was
+        # built with `preprocess.py --ann-lists`
+        self.readme_index = load_index(self.paths[1])
+
+        # The row of repository_features of each README, and the row of
+        # repository_readmes of each repository, -1 if there is none
+        if prepared != None:
+            self.repository_rows = prepared['repository_rows']
+            self.readme_rows = prepared['readme_rows']
+        else:
+            self.repository_rows = self.repository_features.rows(self.repository_readmes[1])
+            found = self.repository_rows >= 0
+            self.readme_rows = np.full(len(self.repository_features.repos), -1, dtype=np.int64)
+            self.readme_rows[self.repository_rows[found]] = np.flatnonzero(found)
+
+        self.loaded_at = time.time()
+
+
+class ModelStore(object):
+    """
+    Holds the current `RepositoryModel` and swaps in a new one when the
+    repository data changes.
+
+    The data files are checked at most every `interval` seconds. When they
+    have changed, the new model is loaded in a background thread while
+    requests keep using the current one, which is then replaced in one
+    assignment. If loading fails, e.g. because the files are being written,
+    the current model is kept and loading is tried again on a later check.
+
+    The model is loaded when the store is created. If there is no data yet,
+    it is loaded on the first call of `current` instead.
+
+    Arguments:
+    ==========
+
+    base_path: Directory where the data files are located
+    interval: Seconds between checks for changed data files
+    """
+
+    def __init__(self, base_path, interval=2.0):
+        self.base_path = base_path
+        self.interval = interval
+        self.model = None
+
+        self._checked_at = time.time()
+        self._reloading = False
+        self._lock = threading.Lock()
+
+        try:
+            self.model = self._load()
+        except (IOError, OSError):
+            pass
+
+    def _load(self):
+        return RepositoryModel(self.base_path)
+
+    def _retire(self, model):
+        # Called with a model that has been replaced; requests may still use it
+        pass
+
+    def current(self):
+        """Returns the current model, starting a reload if data has changed."""
+        model = self.model
+
+        if model == None:
+            with self._lock:
+                if self.model == None:
+                    self.model = self._load()
+                return self.model
+
+        if time.time() - self._checked_at >= self.interval:
+            with self._lock:
+                self._checked_at = time.time()
+                if not self._reloading and data_version(model.paths) != model.version:
+                    self._reloading = True
+                    threading.Thread(target=self._reload, daemon=True).start()
+
+        return model
+
+    def _reload(self):
+        try:
+            model = self._load()
+            # Only swap in completely written data
+            if data_version(model.paths) == model.version:
+                old, self.model = self.model, model
+                self._retire(old)
+            else:
+                self._retire(model)
+        except Exception as e:
+            print('Reloading repository data failed: {}'.format(e))
+        finally:
+            with self._lock:
+                self._reloading = False
+
+
+if __name__ == '__main__':
+
+    print('')
+    print('Prepare repository data for serving')
+    print('===================================\n')
+
+    base = os.path.abspath(os.path.dirname(__file__) + '/../output')
+    if len(sys.argv) > 1:
+        base = sys.argv[1]
+
+    model = prepare(base)
+    print('Saved the features of {} repositories to `{}`\n'.format(
+        len(model.repository_features.repos), model.paths[2]))
+    print('All done.')
+    print('')
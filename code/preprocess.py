@@ -1,10 +1,40 @@
+import argparse
+import codecs
+import hashlib
+import json
+import os
 import re
+import numpy as np
 import pandas as pd
 import sys
-from sklearn.feature_extraction.text import TfidfVectorizer
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+import store
+from ann import build_index
+from cache import TokenCache
 import nltk                                
 nltk.download('averaged_perceptron_tagger')
 
+# Words matching these patterns are removed: links, git URLs, e-mail
+# addresses, commands and paths. A word is a run of non-whitespace, as in
+# str.split, and the patterns are matched from the start of the word.
+PATTERNS = re.compile(r'(?<!\S)(?:\S?(?:http|git|[!;])|\S*[@\\/:|$*#()])\S*')
+
+BRACKETS = [('[', ']'), ('<','>'), ('{','}'), ('(http', ')')]
+
+# Part of the token cache keys; change when `tokenize` or `filter_pos` is
+# changed so that their output changes
+TOKENIZER_VERSION = 1
+
+# Non-ASCII characters are replaced with spaces when encoding to ASCII, and
+# the other special characters are then removed from the bytes
+KEEPCHARS = u' 0123456789abcdefghijklmnopqrstuvwxyz'
+SPECIALS = bytes(i for i in range(128) if chr(i) not in KEEPCHARS)
+codecs.register_error('tokenize', lambda e: (u' ' * (e.end - e.start), e.end))
+
 def tokenize(line, minlength):
     """
     Remove special characters, links, words below minlength and 
@@ -20,41 +50,27 @@ def tokenize(line, minlength):
         line = line.replace('\n', '').replace('\r', '').replace('"', '\'').replace('\'', '').replace('`','')
         line = line.lower()
 
-        # # Remove patterns (more may be added)
-        # p_url = re.compile('^.?http')
-        # p_git = re.compile('^.?git')
-        # p_at = re.compile('.*@.*')
-        # p_exc = re.compile('^.?[!;]')
-        # p_bslash = re.compile('.*[\\\].*')
-        # p_fslash = re.compile('.*[/:|$*#()].*')
-
-        patterns = re.compile('^.?http|''^.?git|''.*@.*|''^.?[!;]|''.*[\\\].*|''.*[/].*|''.*[/:|$*#()].*')
-
         # Remove bracketed parts:
-        line = remove_bracketed(line, brackets=[('[', ']'), ('<','>'), ('{','}'), ('(http', ')')])
+        line = remove_bracketed(line, brackets=BRACKETS)
 
-        pattern_free = []
-        pattern_free.append([word for word in line.split() if not patterns.match(word)])
-        line = ' '.join(pattern_free[0])
+        line = ' '.join(PATTERNS.sub('', line).split())
 
         # Remove the rest of the special characters
-        keepchars = u' 0123456789abcdefghijklmnopqrstuvwxyz'
-        keeper = []
-        keeper.append([ch if (ord(ch) < 128) else ' ' for ch in line])
-        line = ''.join(keeper[0])
-        keeper = []
-        keeper.append([ch for ch in line if ch in keepchars])
-        keeper = ' '.join(''.join(keeper[0]).split()).strip()
+        line = line.encode('ascii', 'tokenize').translate(None, SPECIALS).decode('ascii')
 
         # Remove words shorter than minlength
-        keeper = ' '.join([x for x in keeper.split() if len(x) >= minlength])
-        return keeper
+        return ' '.join([x for x in line.split() if len(x) >= minlength])
     else: return ''
 
 def remove_bracketed(line, brackets):
     """
     Remove content between listed brackets. 
 
+    Each pair of brackets is removed in turn: the content from the first
+    start to the first end is removed, as long as the line has both. If the
+    first end comes before the first start, all of the starts and ends are
+    replaced with spaces instead. This is done in a single pass over the line.
+
     Arguments:
     ==========
 
@@ -62,33 +78,210 @@ def remove_bracketed(line, brackets):
     brackets: tuples of start/end characters/strings.
     """
 
-    for bracket in brackets:
-        while line.find(bracket[0]) != -1 and line.find(bracket[1]) != -1:
-            # Remove inverted brackets
-            if line.find(bracket[0]) > line.find(bracket[1]):
-                line = line.replace(bracket[0], ' ')
-                line = line.replace(bracket[1], ' ')
-            # Remove content between valid brackets
-            else: line = line[:line.index(bracket[0])] + line[line.index(bracket[1])+1:]
+    for start, end in brackets:
+        line = _remove_bracketed(line, start, end)
     return line
 
+def _remove_bracketed(line, start, end):
+    # The line is scanned from `pos` on, and `kept` holds the parts before
+    # `pos` that are kept. Those never contain `end`, or a complete `start`,
+    # but the last characters kept may begin a `start` that continues at
+    # `pos` (e.g. "(ht" + "tp"), so `tail` tracks them.
+    kept, tail, pos = [], '', 0
+    k = len(start) - 1
+
+    while True:
+        # Number of characters of a `start` that were already kept, if any
+        overlap = 0
+        if k > 0 and tail:
+            idx = (tail + line[pos:pos + k]).find(start)
+            if 0 <= idx < len(tail):
+                overlap = len(tail) - idx
+
+        first_start = pos if overlap else line.find(start, pos)
+        first_end = line.find(end, pos)
+        if first_start == -1 or first_end == -1:
+            break
+
+        # Remove inverted brackets
+        if first_start > first_end:
+            return (''.join(kept) + line[pos:]).replace(start, ' ').replace(end, ' ')
+
+        # Remove content between valid brackets
+        if overlap:
+            kept = _drop_last(kept, overlap)
+        else:
+            kept.append(line[pos:first_start])
+        pos = first_end + 1
+
+        if k > 0:
+            tail = _last(kept, k)
+
+    return ''.join(kept) + line[pos:]
+
+def _last(parts, n):
+    """Returns the last n characters of ''.join(parts)."""
+    result = ''
+    for part in reversed(parts):
+        result = part[-(n - len(result)):] + result
+        if len(result) >= n:
+            break
+    return result
+
+def _drop_last(parts, n):
+    """Returns parts with the last n characters of ''.join(parts) removed."""
+    while n > 0:
+        part = parts.pop()
+        if len(part) > n:
+            parts.append(part[:-n])
+        n -= min(n, len(part))
+    return parts
+
+def read_readmes(path):
+    """
+    Read the READMEs of a vectorized dataset, either a `.store` directory or
+    a CSV-file, as a Series indexed by repository.
+    """
+    if os.path.isdir(path):
+        _, repos, _ = store.load(path)
+        # READMEs have always been tokenized in the form they were written to
+        # the CSV-files, i.e. as bytes literals, so keep doing that
+        readmes = [0 if readme == None else str(readme) for readme in store.load_readmes(path)]
+        return pd.Series(readmes, index=np.asarray(repos, dtype=object), name='readme')
+
+    return pd.read_csv(path, index_col=0, low_memory=False).fillna(0).loc['readme']
+
 def filter_pos(text, pos):
     """Returns only selected parts of speech. Parameter pos: string of POS tags"""
     pos_tagged = nltk.pos_tag(text.split())
     return ' '.join([word[0] for word in pos_tagged if word[1] in pos.split()])
 
-def tfidf(user_readmes, repository_readmes, nb_features):
-    """Returns vector representations of user's READMEs and repository READMEs"""
-    all_readmes = pd.concat([user_readmes, repository_readmes], axis=0)
-    tfidf_vectorizer = TfidfVectorizer(max_df=0.95, min_df=2, max_features=nb_features, stop_words='english')
-    tfidf = tfidf_vectorizer.fit_transform(all_readmes)
-    feature_names = tfidf_vectorizer.get_feature_names()
+def process_chunk(readmes, minlength, pos):
+    """Tokenizes and POS filters a list of READMEs"""
+    return [filter_pos(tokenize(readme, minlength=minlength), pos=pos) for readme in readmes]
+
+def process_readmes(readmes, minlength, pos, workers=1, chunksize=200):
+    """
+    Tokenize and POS filter READMEs in chunks, with the chunks processed in
+    parallel by a pool of `workers` processes. The result is the same as
+    tokenizing and filtering the READMEs one by one.
+
+    At most two chunks per worker are in flight at a time, and only the
+    filtered READMEs are kept, so memory use does not grow with the number
+    of chunks waiting to be processed.
+
+    Arguments:
+    ==========
+
+    readmes: A Series of READMEs
+    minlength: see `tokenize`
+    pos: see `filter_pos`
+    workers: Number of worker processes, 1 to process in this process
+    chunksize: Number of READMEs per chunk
+
+    Returns:
+    ========
+
+    A Series of tokenized and POS filtered READMEs with the index of `readmes`
+    """
+    chunks = (readmes.iloc[i:i + chunksize].tolist() for i in range(0, readmes.shape[0], chunksize))
+    results = []
+
+    def report():
+        print('  {} / {} READMEs'.format(sum(len(r) for r in results), readmes.shape[0]))
+
+    if workers <= 1:
+        for chunk in chunks:
+            results.append(process_chunk(chunk, minlength, pos))
+            report()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for chunk in chunks:
+                pending.append(executor.submit(process_chunk, chunk, minlength, pos))
+                if len(pending) >= 2 * workers:
+                    results.append(pending.pop(0).result())
+                    report()
+            for future in pending:
+                results.append(future.result())
+                report()
+
+    return pd.Series([readme for result in results for readme in result], index=readmes.index, dtype=object)
+
+def process_cached(readmes, cache, minlength, pos, **kwargs):
+    """
+    Like `process_readmes`, but READMEs found in `cache` (a
+    `cache.TokenCache`) are not processed again, and the processed ones are
+    added to it. Identical READMEs are only processed once.
+    """
+    settings = [TOKENIZER_VERSION, minlength, pos]
+    keys = [cache.key(readme, settings) for readme in readmes]
+
+    tokens = {}
+    for key in keys:
+        if key not in tokens:
+            tokens[key] = cache.get(key)
+
+    missing = [key for key in tokens if tokens[key] == None]
+    readme_of = dict(zip(keys, readmes.values))
+    processed = process_readmes(pd.Series([readme_of[key] for key in missing], index=missing, dtype=object),
+        minlength, pos, **kwargs)
 
-    tfidf_dense = tfidf.todense()
-    user_docvecs = pd.DataFrame(tfidf_dense[:user_readmes.shape[0]], index=user_readmes.index, columns=feature_names)
-    repository_docvecs = pd.DataFrame(tfidf_dense[user_readmes.shape[0]:], index=repository_readmes.index, columns=feature_names)
+    for key, value in processed.items():
+        cache.put(key, value)
+        tokens[key] = value
 
-    return user_docvecs, repository_docvecs
+    return pd.Series([tokens[key] for key in keys], index=readmes.index, dtype=object)
+
+def fit_tfidf(readmes, nb_features):
+    """
+    Fit the TF-IDF model on the repository READMEs.
+
+    Returns:
+    ========
+
+    docvecs: A sparse matrix with a row for each README and a column for each
+             term. The rows are L2-normalized, which `recommend_readme` relies on
+    feature_names: The terms
+    idf: The inverse document frequency of each term
+    """
+    tfidf_vectorizer = TfidfVectorizer(max_df=0.95, min_df=2, max_features=nb_features, stop_words='english', norm='l2')
+    docvecs = tfidf_vectorizer.fit_transform(readmes)
+    vocabulary = tfidf_vectorizer.vocabulary_
+    feature_names = sorted(vocabulary, key=vocabulary.get)
+
+    return docvecs, feature_names, tfidf_vectorizer.idf_
+
+def transform_tfidf(readmes, feature_names, idf):
+    """
+    Returns vector representations of READMEs with a TF-IDF model fitted by
+    `fit_tfidf`, as a sparse matrix. The same as the TfidfVectorizer fitted
+    on the repository READMEs would return, without refitting it.
+    """
+    if len(readmes) == 0:
+        return sparse.csr_matrix((0, len(feature_names)))
+
+    count_vectorizer = CountVectorizer(vocabulary=list(feature_names), stop_words='english')
+    counts = count_vectorizer.transform(readmes)
+    return normalize(sparse.csr_matrix(counts.multiply(np.asarray(idf))))
+
+def model_fingerprint(feature_names, idf):
+    """
+    Returns a hash of the vocabulary and IDF of a TF-IDF model. It is saved
+    with every set of README vectors transformed with the model, so that
+    vectors of different models are never compared, see
+    `model.is_same_model`.
+    """
+    digest = hashlib.sha1(json.dumps([str(name) for name in feature_names]).encode('utf-8'))
+    digest.update(np.asarray(idf, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def save_docvecs(out, docvecs, index, feature_names, arrays=None, csv=False):
+    """Save vector representations of READMEs, also as CSV if `csv`"""
+    print('Saving data with a shape of {} to `{}`'.format(docvecs.shape, out))
+    store.save(out, docvecs, index, feature_names, arrays=arrays)
+    if csv:
+        pd.DataFrame(docvecs.toarray(), index=index, columns=feature_names).to_csv(out.replace('.store', '.csv'))
 
 
 if __name__ == '__main__':    
@@ -96,44 +289,92 @@ if __name__ == '__main__':
     print('Github data README preprocessor')
     print('======================\n')
 
-    if len(sys.argv) != 3:
-        print('Usage:\n\tpython preprocess.py user.csv data.csv\n')
-        sys.exit(0)
+    parser = argparse.ArgumentParser(prog='python preprocess.py')
+    parser.add_argument('in_1', metavar='user.store')
+    parser.add_argument('in_2', metavar='data.store', nargs='?',
+        help='repository dataset to fit the TF-IDF model on; without it, only '
+             'the user\'s READMEs are transformed with the saved model')
+    parser.add_argument('--model', default='./output/data_tok.store',
+        help='TF-IDF model saved when fitting, used when data.store is not given '
+             '(default: %(default)s)')
+    parser.add_argument('--max-features', type=int, default=20000,
+        help='maximum number of terms in the TF-IDF model (default: %(default)s)')
+    parser.add_argument('--ann-lists', type=int, default=0,
+        help='build an approximate nearest neighbor index of the repository '
+             'READMEs with this many lists, e.g. the square root of the number '
+             'of repositories; 0 for no index (default: %(default)s)')
+    parser.add_argument('--csv', action='store_true',
+        help='also save the output as CSV, with a row for each repository')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of processes tokenizing and POS tagging READMEs')
+    parser.add_argument('--chunksize', type=int, default=200,
+        help='number of READMEs given to a process at a time')
+    args = parser.parse_args()
+
+    in_1 = args.in_1
+    in_2 = args.in_2
+
+    if in_2 != None:
+        print('Reading `{}` and `{}` as input files\n'.format(in_1, in_2))
+    else:
+        print('Reading `{}` as input file\n'.format(in_1))
 
-    in_1 = sys.argv[1]
-    in_2 = sys.argv[2]
-    
-    print('Reading `{}` and `{}` as input files\n'.format(in_1, in_2))
+    name_1 = os.path.basename(os.path.normpath(in_1)).split('.')[0]
+    out_1 = './output/{}_tok.store'.format(name_1)
 
-    user_readmes = pd.read_csv(in_1, index_col=0, low_memory=False).fillna(0).loc['readme']
-    repository_readmes = pd.read_csv(in_2, index_col=0, low_memory=False).fillna(0).loc['readme']
-    
-    # Tokenize readmes
-    user_readmes = user_readmes.apply(tokenize, minlength=3)
-    repository_readmes = repository_readmes.apply(tokenize, minlength=3)
+    # The tokenized and POS filtered READMEs are cached, so that only new
+    # and changed READMEs need to be processed again
+    cache = TokenCache('./output/tokens.cache.json')
 
-    # Part-of-speech (POS) tagging: 
+    # Tokenize readmes and do part-of-speech (POS) tagging:
     # Preserve only selected parts of speech
     # verbs = u'VB VBG'
     # nouns = u'NN NNS NNP NNPS' 
     nouns = u'NN' 
-    print('POS tagging words from {}, please wait...'.format(in_1))
-    user_readmes = user_readmes.apply(filter_pos, pos=nouns)
-    print('POS tagging words from {}, please wait...'.format(in_2))
-    repository_readmes = repository_readmes.apply(filter_pos, pos=nouns)
+    print('Tokenizing and POS tagging words from {}, please wait...'.format(in_1))
+    user_readmes = process_cached(read_readmes(in_1), cache, 3, nouns, workers=args.workers, chunksize=args.chunksize)
 
-    # Apply TF-IDF transform to mitigate the effect of words that appear in most readmes
-    user_docvecs, repository_docvecs = tfidf(user_readmes, repository_readmes, nb_features=3000)
+    # Apply TF-IDF transform to mitigate the effect of words that appear in
+    # most readmes. The model is fitted on the repository READMEs only and
+    # saved with them, so that adding a user does not change the vectors of
+    # the repositories.
+    if in_2 != None:
+        name_2 = os.path.basename(os.path.normpath(in_2)).split('.')[0]
+        out_2 = './output/{}_tok.store'.format(name_2)
 
-    out_1 = './output/{}'.format(in_1.split('/')[-1].split('.')[-2]) + '_tok.csv'
-    out_2 = './output/{}'.format(in_2.split('/')[-1].split('.')[-2]) + '_tok.csv'
+        print('Tokenizing and POS tagging words from {}, please wait...'.format(in_2))
+        repository_readmes = process_cached(read_readmes(in_2), cache, 3, nouns, workers=args.workers, chunksize=args.chunksize)
 
-    print('Saving data to `{}` and `{}`\n'.format(out_1, out_2))
-    print('Saved data has shapes of {} and {}\n'.format(user_docvecs.shape, repository_docvecs.shape))
+        repository_docvecs, feature_names, idf = fit_tfidf(repository_readmes, nb_features=args.max_features)
+        fingerprint = model_fingerprint(feature_names, idf)
 
-    user_docvecs.to_csv(out_1)
-    repository_docvecs.to_csv(out_2)
+        arrays = {'idf': idf, 'model': np.array(fingerprint)}
+        if args.ann_lists > 0:
+            print('Building an index of the READMEs with {} lists'.format(args.ann_lists))
+            arrays.update(build_index(repository_docvecs, n_lists=args.ann_lists).arrays())
 
-    print('All done.')
+        save_docvecs(out_2, repository_docvecs, repository_readmes.index, feature_names,
+            arrays=arrays, csv=args.csv)
+    else:
+        out_2 = args.model
+        _, _, feature_names = store.load(out_2)
+        idf = store.load_array(out_2, 'idf')
+        if idf is None:
+            print('No TF-IDF model found in `{}`, run preprocess.py with data.store first.'.format(out_2))
+            sys.exit(1)
+        saved = store.load_array(out_2, 'model', mmap=False)
+        fingerprint = model_fingerprint(feature_names, idf) if saved is None else str(saved)
+
+    # Only evict cached READMEs when the whole corpus was processed
+    cache.save(evict=in_2 != None)
     print('')
+    print(cache.stats())
+    print('')
+
+    user_docvecs = transform_tfidf(user_readmes, feature_names, idf)
+    save_docvecs(out_1, user_docvecs, user_readmes.index, feature_names,
+        arrays={'model': np.array(fingerprint)}, csv=args.csv)
 
+    print('')
+    print('All done.')
+    print('')
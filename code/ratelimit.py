@@ -0,0 +1,164 @@
+'''
+Rate limit aware scheduling of Github API requests.
+'''
+import threading
+import time
+
+import requests as rq
+
+
+class TokenScheduler(object):
+    """
+    Spreads Github API requests over one or more access tokens while keeping
+    each token within its rate limit.
+
+    The `X-RateLimit-Remaining`, `X-RateLimit-Limit` and `X-RateLimit-Reset`
+    headers of every response are tracked per token. Each request uses the
+    token with the most requests remaining. When a token gets low (below
+    `reserve` of its limit), its remaining requests are paced evenly over
+    the time left until the reset, and when every token is exhausted the
+    scheduler waits for the earliest reset instead of failing.
+
+    Requests hitting a rate limit (403/429), a secondary rate limit or a
+    server error are retried with exponential backoff, honouring
+    `Retry-After` when Github sends it.
+
+    Arguments:
+    ==========
+
+    tokens: A list of Github access tokens
+    max_retries: How many times a failed request is retried
+    backoff: Initial backoff in seconds, doubled for every retry
+    reserve: Fraction of the limit below which requests are paced
+    """
+
+    def __init__(self, tokens, max_retries=5, backoff=1.0, reserve=0.1):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.reserve = reserve
+        self.retries = 0
+
+        self._lock = threading.Lock()
+        self._tokens = [{
+            "token": token,
+            "remaining": None,  # Unknown until the first response
+            "limit": None,
+            "reset": 0.0,
+            "next": 0.0,        # Earliest time the token may be used again
+        } for token in tokens]
+
+    def _acquire(self):
+        # Pick the usable token with the most requests remaining. If there
+        # is none, sleep until one becomes usable.
+        while True:
+            with self._lock:
+                now = time.time()
+                usable, wake = [], []
+
+                for state in self._tokens:
+                    if state["remaining"] == 0 and state["reset"] <= now:
+                        state["remaining"] = None
+                    if state["remaining"] == 0:
+                        wake.append(state["reset"])
+                    elif state["next"] > now:
+                        wake.append(state["next"])
+                    else:
+                        usable.append(state)
+
+                if len(usable) > 0:
+                    state = max(usable, key=lambda s: float("inf") if s["remaining"] == None else s["remaining"])
+                    self._reserve(state, now)
+                    return state
+
+                delay = min(wake) - now
+
+            time.sleep(min(max(delay, 0.05), 60))
+
+    def _reserve(self, state, now):
+        # Count the request against the token before it is made, so that
+        # concurrent callers do not all pick the same almost empty token
+        if state["remaining"] == None:
+            return
+        state["remaining"] -= 1
+
+        if state["limit"] != None and state["remaining"] < self.reserve * state["limit"]:
+            window = max(state["reset"] - now, 0)
+            state["next"] = now + window / max(state["remaining"], 1)
+
+    def _update(self, state, response):
+        headers = response.headers
+        if "X-RateLimit-Remaining" not in headers:
+            return
+
+        with self._lock:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = float(headers.get("X-RateLimit-Reset", 0))
+
+            # Responses of concurrent requests arrive in any order, so within
+            # one window only ever lower the count
+            if reset != state["reset"] or state["remaining"] == None:
+                state["remaining"] = remaining
+            else:
+                state["remaining"] = min(state["remaining"], remaining)
+
+            state["reset"] = reset
+            if "X-RateLimit-Limit" in headers:
+                state["limit"] = int(headers["X-RateLimit-Limit"])
+
+    def _hold(self, state, delay):
+        with self._lock:
+            self.retries += 1
+            state["next"] = max(state["next"], time.time() + delay)
+
+    def request(self, session, method, url, headers, **kwargs):
+        """
+        Makes a request with `session`, adding the Authorization header of
+        the chosen token to `headers`. Returns the response of the last
+        attempt.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff * 2 ** attempt
+
+            state = self._acquire()
+            headers = dict(headers)
+            headers["Authorization"] = "bearer {}".format(state["token"])
+
+            try:
+                response = session.request(method, url, headers=headers, **kwargs)
+            except (rq.ConnectionError, rq.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                self._hold(state, delay)
+                continue
+
+            self._update(state, response)
+
+            if attempt == self.max_retries:
+                return response
+
+            if response.status_code in (403, 429):
+                if "Retry-After" in response.headers:
+                    # Secondary rate limit with an explicit wait
+                    self._hold(state, float(response.headers["Retry-After"]))
+                    continue
+                if state["remaining"] == 0:
+                    # Primary rate limit; another token or the reset will do
+                    with self._lock:
+                        self.retries += 1
+                    continue
+                if "rate limit" in response.text.lower() or "abuse" in response.text.lower():
+                    self._hold(state, delay)
+                    continue
+            elif response.status_code >= 500:
+                self._hold(state, delay)
+                continue
+
+            return response
+
+    def status(self):
+        """Returns a one-line summary of the remaining requests per token."""
+        with self._lock:
+            parts = ["{}/{}".format(
+                "?" if s["remaining"] == None else s["remaining"],
+                "?" if s["limit"] == None else s["limit"]) for s in self._tokens]
+        return "Tokens: {} remaining, {} retries".format(", ".join(parts), self.retries)
@@ -4,51 +4,218 @@ import helper
 import sys
 import os
 
-from sklearn.metrics import pairwise_distances
+from scipy import sparse
+from vectorize import inverted_index
 
 
-def recommend_lang(user_data, repository_data):
+class RepositoryFeatures(object):
     """
-    Make recommendations for user.
-    If `user_data` and `repository_data` are not instances of Pandas Series or
-    DataFrame, respectively, then raise TypeError.
+    The language and topic features of the repositories, prepared once for
+    scoring any number of users.
+
+    All the attributes are NumPy arrays or scipy.sparse matrices of them,
+    except for the small `feature_columns`, so that they can be saved with
+    `arrays` and memory-mapped by every process serving requests, see
+    `model.prepare`.
+
     Arguments:
     ==========
-    user_data: A Pandas series containing users values.
-    repository_data: A Pandas DataFrame containing repository information
-    Returns:
-    ========
-    result: A Pandas Series, where indices are repository names and values are
-            the scores for the repositories.
-    """
 
-    if type(user_data) != pd.Series and type(repository_data) != pd.DataFrame:
-        raise TypeError("user_data must be Pandas Series and repository_data must be a Pandas DataFrame")
+    repository_data: The vectorized repositories, as returned by `store.load`
+    postings: The inverted index of the repositories, as returned by
+              `vectorize.inverted_index`; built from repository_data if not given
+
+    Attributes:
+    ===========
+
+    repos: Repository names, one per row of the matrices
+    sorted_repos, repo_order: The repository names sorted, and their rows
+    languages: Language names (`l_*`), one per column of `language_matrix`
+    language_matrix: A binary scipy.sparse CSR matrix of shape (repositories, languages)
+    language_norms: The L2 norm of each row of `language_matrix`
+    topics: Topic names (`t_*`), one per column of `topic_matrix`
+    topic_matrix: A binary scipy.sparse CSR matrix of shape (repositories, topics)
+    topic_sums: The sum of the topic values of each repository, i.e. the
+                number of topics
+    feature_columns: The column of each language and topic in the inverted
+                     index, by name
+    postings_indptr, postings_rows: The inverted index
+    """
 
-    # Drop repositories the user already has from repository_data
-    repository_data = repository_data.drop(
-        np.intersect1d(repository_data.columns, user_data.columns), axis='columns')
+    def __init__(self, repository_data, postings=None):
+        matrix, repos, features = repository_data[0], repository_data[1], repository_data[2]
+        matrix = sparse.csr_matrix(matrix)
+        features = np.asarray(features, dtype=str)
+        repos = np.asarray(repos, dtype=str)
+        repo_order = np.argsort(repos, kind='mergesort')
+
+        # Repositories have a language when they have any code in it; the
+        # stored zeros of `l_unknown` do not count
+        is_lang = np.array([feature.startswith('l_') for feature in features], dtype=bool)
+        language_matrix = sparse.csr_matrix(matrix[:, np.flatnonzero(is_lang)] != 0, dtype=np.float64)
+
+        is_topic = np.array([feature.startswith('t_') for feature in features], dtype=bool)
+        topic_values = matrix[:, np.flatnonzero(is_topic)]
+        topic_matrix = sparse.csr_matrix(topic_values != 0, dtype=np.float64)
+
+        if postings == None:
+            postings = inverted_index(matrix)
+
+        self._set_arrays({
+            'repos': repos,
+            'sorted_repos': repos[repo_order],
+            'repo_order': repo_order,
+            'features': features,
+            'languages': features[is_lang],
+            'language_data': language_matrix.data,
+            'language_indices': language_matrix.indices,
+            'language_indptr': language_matrix.indptr,
+            'language_norms': np.sqrt(np.asarray(language_matrix.sum(axis=1)).ravel()),
+            'topics': features[is_topic],
+            'topic_data': topic_matrix.data,
+            'topic_indices': topic_matrix.indices,
+            'topic_indptr': topic_matrix.indptr,
+            'topic_sums': np.asarray(topic_values.sum(axis=1)).ravel(),
+            'postings_indptr': postings['postings_indptr'],
+            'postings_rows': postings['postings_rows'],
+        })
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Returns the `RepositoryFeatures` of the arrays returned by `arrays`, without copying them."""
+        repository_features = cls.__new__(cls)
+        repository_features._set_arrays(arrays)
+        return repository_features
+
+    def _set_arrays(self, arrays):
+        self._arrays = arrays
+
+        self.repos = arrays['repos']
+        self.sorted_repos = arrays['sorted_repos']
+        self.repo_order = arrays['repo_order']
+
+        self.languages = arrays['languages']
+        self.language_matrix = sparse.csr_matrix(
+            (arrays['language_data'], arrays['language_indices'], arrays['language_indptr']),
+            shape=(len(self.repos), len(self.languages)), copy=False)
+        self.language_norms = arrays['language_norms']
+
+        self.topics = arrays['topics']
+        self.topic_matrix = sparse.csr_matrix(
+            (arrays['topic_data'], arrays['topic_indices'], arrays['topic_indptr']),
+            shape=(len(self.repos), len(self.topics)), copy=False)
+        self.topic_sums = arrays['topic_sums']
+
+        self.feature_columns = {feature: idx for idx, feature in enumerate(arrays['features'])}
+        self.postings_indptr = arrays['postings_indptr']
+        self.postings_rows = arrays['postings_rows']
+
+    def arrays(self):
+        """Returns the arrays of the features by name, for `store.save_arrays`."""
+        return dict(self._arrays)
+
+    def candidates(self, features):
+        """Returns the sorted rows of the repositories having any of `features`"""
+        columns = [self.feature_columns[f] for f in features if f in self.feature_columns]
+        postings = [self.postings_rows[self.postings_indptr[c]:self.postings_indptr[c + 1]] for c in columns]
+        return np.unique(np.concatenate(postings)) if postings else np.array([], dtype=np.int64)
+
+    def rows(self, repos):
+        """Returns the row of each of `repos`, -1 for the ones not found"""
+        repos = np.asarray(repos, dtype=str)
+        if len(self.repos) == 0 or len(repos) == 0:
+            return np.full(len(repos), -1, dtype=np.int64)
+
+        idx = np.minimum(np.searchsorted(self.sorted_repos, repos), len(self.repos) - 1)
+        found = self.sorted_repos[idx] == repos
+        return np.where(found, self.repo_order[idx], -1).astype(np.int64)
+
+    def exclude(self, repos):
+        """Returns a boolean mask of the repositories that are not in `repos`"""
+        rows = self.rows(repos)
+        keep = np.ones(len(self.repos), dtype=bool)
+        keep[rows[rows >= 0]] = False
+        return keep
+
+
+def lang_profile(user_data, repository_features):
+    """
+    The user's language vector for `lang_scores`: the binarized languages,
+    minus their mean, over `repository_features.languages`, and its norm.
+    """
+    user_matrix, user_features = user_data[0], user_data[2]
 
-    # Reshape user data and repository data
-    user_data, repository_data = reshape(user_data, repository_data)
+    # Collapse user data to one binary vector of languages: the user has a
+    # language if the lines of code in it sum up to at least one
+    counts = np.asarray(user_matrix.sum(axis=0)).ravel().astype(int)
+    is_lang = np.array([feature.startswith('l_') for feature in user_features], dtype=bool)
+    user_langs = user_features[is_lang & (counts != 0)]
 
-    # Keep only language-related data
-    user_data = user_data.loc[user_data.index.str.startswith('l_')]
-    repository_data = repository_data.loc[repository_data.index.str.startswith('l_')]
+    # The languages of the user and the repositories together
+    n_langs = len(np.union1d(repository_features.languages, user_features[is_lang]))
 
     # Subtract user_data mean from user data to differentiate between the following cases:
     # Bad match: Repo has language A, user does not have language A
     # Neutral match: Neither has language A
     # Without subtraction, cosine similarity gives 0 for both.
     # With subtraction, the bad match gets a lower rating than the neutral match.
-    user_data = user_data - user_data.mean()
-    lang_similarities = 1 - pairwise_distances(
-        repository_data.T,
-        user_data.values.reshape(1, -1),
-        metric='cosine',
-        n_jobs=1)
+    mean = len(user_langs) / float(n_langs)
+    user_vec = np.isin(repository_features.languages, user_langs) - mean
+    user_norm = np.sqrt(len(user_langs) * (1 - mean) ** 2 + (n_langs - len(user_langs)) * mean ** 2)
+
+    return user_vec, user_norm
+
+
+def lang_scores(user_data, repository_features, rows=None):
+    """
+    The language similarities of `recommend_lang` as an array with a value
+    for each row of `repository_features`, including the user's own
+    repositories, or for each of `rows` if given.
+    """
+    user_vec, user_norm = lang_profile(user_data, repository_features)
+
+    language_matrix, language_norms = repository_features.language_matrix, repository_features.language_norms
+    if rows is not None:
+        language_matrix, language_norms = language_matrix[rows], language_norms[rows]
+
+    # Cosine similarity, 0 for repositories without languages
+    dot_products = language_matrix.dot(user_vec)
+    lengths = user_norm * language_norms
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(lengths == 0, 0, dot_products / lengths)
+
+
+def recommend_lang(user_data, repository_features):
+    """
+    Make recommendations for user based on repository languages, with the
+    cosine similarity between the user's binarized languages, minus their
+    mean, and each repository's binarized languages.
+
+    If `user_data` is not a tuple of a scipy.sparse matrix and its row and
+    column names, or `repository_features` is not a `RepositoryFeatures`,
+    then raise TypeError.
+
+    Arguments:
+    ==========
 
-    lang_similarities = pd.Series(lang_similarities.flatten(), index=repository_data.columns)
+    user_data: The user's vectorized repositories, as returned by `store.load`
+    repository_features: `RepositoryFeatures` of the repositories
+
+    Returns:
+    ========
+
+    result: A Pandas Series, where indices are repository names and values are
+            the scores for the repositories.
+    """
+
+    if not sparse.issparse(user_data[0]) or type(repository_features) != RepositoryFeatures:
+        raise TypeError("user_data must be a tuple of a scipy.sparse matrix and row and column names and repository_features must be RepositoryFeatures")
+
+    lang_similarities = lang_scores(user_data, repository_features)
+
+    # Leave out repositories the user already has
+    keep = repository_features.exclude(user_data[1])
+    lang_similarities = pd.Series(lang_similarities[keep], index=repository_features.repos[keep])
 
     # # Normalize to [0,1]
     # lang_similarities = helper.normalize(lang_similarities)
@@ -56,37 +223,74 @@ def recommend_lang(user_data, repository_data):
     return lang_similarities
 
 
-def recommend_topic(user_data, repository_data, username):
+def topic_profile(user_data, repository_features):
+    """
+    The user's topic vector for `topic_scores`: 1 for the topics of
+    `repository_features.topics` the user has, and the number of topics the
+    user has.
+    """
+    user_matrix, user_features = user_data[0], user_data[2]
+
+    # The topics the user has in any of their repositories
+    counts = np.asarray(user_matrix.sum(axis=0)).ravel()
+    is_topic = np.array([feature.startswith('t_') for feature in user_features], dtype=bool)
+    user_topics = user_features[(counts > 0) & is_topic]
+
+    return np.isin(repository_features.topics, user_topics).astype(float), len(user_topics)
+
+
+def topic_scores(user_data, repository_features, rows=None):
+    """
+    The topic similarities of `recommend_topic` as an array with a value for
+    each row of `repository_features`, including the user's own repositories,
+    or for each of `rows` if given.
+    """
+    user_vec, n_topics = topic_profile(user_data, repository_features)
+
+    topic_matrix, topic_sums = repository_features.topic_matrix, repository_features.topic_sums
+    if rows is not None:
+        topic_matrix, topic_sums = topic_matrix[rows], topic_sums[rows]
+
+    # Jaccard similarity between user topics and each repository's topics:
+    # the intersection is the number of the user's topics the repository has
+    intersect = topic_matrix.dot(user_vec)
+    union = n_topics + topic_sums - intersect
+
+    # If no topics marked for either, union and intersect will both be zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union - intersect == 0, 0, intersect / union)
+
+
+def recommend_topic(user_data, repository_features):
     """
-    Make recommendations for user based on repository languages.
-    If `user_data` and `repository_data` are not instances of Pandas Series or
-    DataFrame, respectively, then raise TypeError.
+    Make recommendations for user based on repository topics, with the
+    Jaccard similarity between the user's topics and each repository's.
+
+    If `user_data` is not a tuple of a scipy.sparse matrix and its row and
+    column names, or `repository_features` is not a `RepositoryFeatures`,
+    then raise TypeError.
+
     Arguments:
     ==========
-    user_data: A Pandas series containing users values.
-    repository_data: A Pandas DataFrame containing repository information
+
+    user_data: The user's vectorized repositories, as returned by `store.load`
+    repository_features: `RepositoryFeatures` of the repositories
+
     Returns:
     ========
+
     result: A Pandas Series, where indices are repository names and values are
             the scores for the repositories.
     """
 
-    if type(user_data) != pd.Series and type(repository_data) != pd.DataFrame:
-        raise TypeError("user_data must be Pandas Series and repository_data must be a Pandas DataFrame")
-
-    # Ensure float data type
-    user_data = user_data.drop(['readme']).fillna(0).astype('float')
-    repository_data = repository_data.drop(['readme']).fillna(0).astype('float')
+    if not sparse.issparse(user_data[0]) or type(repository_features) != RepositoryFeatures:
+        raise TypeError("user_data must be a tuple of a scipy.sparse matrix and row and column names and repository_features must be RepositoryFeatures")
 
-    # Drop repositories the user already has from repository_data
-    repository_data = repository_data.drop(
-        np.intersect1d(repository_data.columns, user_data.columns), axis='columns')
+    topic_similarities = topic_scores(user_data, repository_features)
 
-    # Keep only topic-related data
-    user_langs, user_topics, repo_langs, repo_topics = helper.get_langs_topics(user_data, repository_data)
-
-    # Calculate Jaccard similarity between user topics and each repository's topics
-    topic_similarities = repo_topics.apply(helper.jaccard, user_topics=user_topics, axis=0)
+    # Leave out repositories the user already has
+    keep = repository_features.exclude(user_data[1])
+    topic_similarities = pd.Series(topic_similarities[keep], index=repository_features.repos[keep])
 
     # # Normalize to [0,1]
     # topic_similarities = helper.normalize(topic_similarities)
@@ -94,18 +298,53 @@ def recommend_topic(user_data, repository_data, username):
     return topic_similarities
 
 
-def recommend_readme(user_vecs, repository_vecs):
+def readme_scores(user_vecs, repository_vecs, index=None, n_probe=8, rows=None, scored=None):
+    """
+    The README similarities of `recommend_readme` as an array with a value
+    for each row of `repository_vecs`, including the user's own repositories.
+    With `index`, the repositories that are not candidates are NaN.
+
+    If `rows` is given, the array has a value for each of them instead, NaN
+    for rows that are -1. If `scored` is given too, a boolean array like
+    `rows`, only those rows are scored and the others are 0, e.g. the
+    READMEs an `ann.ReadmeIndex` did not find similar.
+    """
+    user_matrix, repository_matrix = user_vecs[0], repository_vecs[0]
+
+    if rows is not None:
+        found = rows >= 0
+        readme_similarities = np.full(len(rows), np.nan)
+        if scored is not None:
+            readme_similarities[found] = 0
+            found &= scored
+        readme_similarities[found] = helper.get_readme_sim(user_matrix, repository_matrix[rows[found]])
+        return readme_similarities
+
+    if index == None:
+        return helper.get_readme_sim(user_matrix, repository_matrix)
+
+    rows = index.candidates(helper.get_readme_vec(user_matrix), n_probe)
+    readme_similarities = np.full(repository_matrix.shape[0], np.nan)
+    readme_similarities[rows] = helper.get_readme_sim(user_matrix, repository_matrix[rows])
+    return readme_similarities
+
+
+def recommend_readme(user_vecs, repository_vecs, index=None, n_probe=8):
     """
     Make recommendations for user based on README similarity.
 
-    If `user_data` and `repository_data` are not instances of Pandas Series or
-    DataFrame, respectively, then raise TypeError.
+    If `user_vecs` and `repository_vecs` are not tuples of a scipy.sparse
+    matrix and its row names, then raise TypeError.
 
     Arguments:
     ==========
 
-    user_data: A Pandas series containing users values.
-    repository_data: A Pandas DataFrame containing repository information
+    user_vecs: The user's README vectors, as returned by `store.load`
+    repository_vecs: The repository README vectors, as returned by `store.load`;
+                     the rows must be L2-normalized, as saved by `preprocess.py`
+    index: An `ann.ReadmeIndex` of repository_vecs; if given, only the
+           repositories it finds as candidates are scored
+    n_probe: Number of lists of the index to search, see `ann.ReadmeIndex.candidates`
 
     Returns:
     ========
@@ -114,15 +353,23 @@ def recommend_readme(user_vecs, repository_vecs):
             the scores for the repositories.
     """
 
-    if type(user_vecs) != pd.Series and type(repository_vecs) != pd.DataFrame:
-        raise TypeError("user_vecs must be Pandas Series and repository_vecs must be a Pandas DataFrame")
+    if not sparse.issparse(user_vecs[0]) or not sparse.issparse(repository_vecs[0]):
+        raise TypeError("user_vecs and repository_vecs must be tuples of a scipy.sparse matrix and row names")
 
-    # Drop repositories the user already has from repository_vecs
-    repos_in_common = np.intersect1d(list(repository_vecs.index), list(user_vecs.index))
-    repository_vecs = repository_vecs.drop(repos_in_common, axis='index')
+    user_matrix, user_repos = user_vecs[0], user_vecs[1]
+    repository_matrix, repository_repos = repository_vecs[0], repository_vecs[1]
+
+    if index != None:
+        # Score only the approximate nearest neighbors
+        rows = index.candidates(helper.get_readme_vec(user_matrix), n_probe)
+        repository_matrix, repository_repos = repository_matrix[rows], repository_repos[rows]
 
     # Compute readme similarities
-    readme_similarities = helper.get_readme_sim(user_vecs, repository_vecs)
+    readme_similarities = helper.get_readme_sim(user_matrix, repository_matrix)
+
+    # Leave out repositories the user already has
+    keep = ~np.isin(repository_repos, user_repos)
+    readme_similarities = pd.Series(readme_similarities[keep], index=np.asarray(repository_repos[keep], dtype=object))
 
     # # Normalize to [0,1]
     # readme_similarities = helper.normalize(readme_similarities)
@@ -130,57 +377,141 @@ def recommend_readme(user_vecs, repository_vecs):
     return readme_similarities
 
 
-def reshape(user_data, repo_data):
-    """
-    Collapses user_data to one binary vector containing languages and topics.
-    Ensures there's no NA-values in data.
-    Converts datatypes to int and binarizes the data
-    Reshapes user_data and repo_data to similar dimensions, i.e. both will have same number of features.
+def candidate_rows(user_data, repository_features, extra=None, min_candidates=1000):
     """
+    Returns the rows of the repositories worth scoring for a user: the ones
+    that have any of the user's languages or topics, found with the inverted
+    index, and the `extra` rows (e.g. similar READMEs). If there are fewer
+    than `min_candidates` of them, all the rows are returned instead, so that
+    users with few or rare languages and topics still get recommendations.
 
-    if type(user_data) != pd.DataFrame and type(repo_data) != pd.DataFrame:
-        raise TypeError("user_data and repo_data must be Pandas DataFrames.")
+    Arguments:
+    ==========
 
-    if "readme" in user_data.index:
-        user_data = user_data.drop("readme", axis="index")
+    user_data: The user's vectorized repositories, as returned by `store.load`
+    repository_features: `RepositoryFeatures` of the repositories
+    extra: Other rows to include; optional
+    min_candidates: The smallest number of candidates that is used
+    """
+    user_matrix, user_features = user_data[0], user_data[2]
 
-    if "readme" in repo_data.index:
-        repo_data = repo_data.drop("readme", axis="index")
+    counts = np.asarray(user_matrix.sum(axis=0)).ravel()
+    features = [feature for feature, count in zip(user_features, counts)
+                if count != 0 and (feature.startswith('l_') or feature.startswith('t_'))]
 
-    # Remove NA-values
-    user_data = user_data.fillna(0)
-    repo_data = repo_data.fillna(0)
+    rows = repository_features.candidates(features)
+    if extra is not None:
+        rows = np.union1d(rows, extra)
 
-    # Collapse user_data to sum of languages and topics and convert to int
-    user_data = user_data.sum(axis=1)
-    user_data = user_data.astype(float).astype(int)
+    n_rows = len(repository_features.repos)
+    if len(rows) < min(min_candidates, n_rows):
+        return np.arange(n_rows)
+    return rows
 
-    # Binarize user_data and repo_data
-    user_data[user_data != 0] = 1
-    repo_data[repo_data != 0] = 1
 
-    # Rename, so we can access it via column name
-    user_data = user_data.rename('User')
+def similar_readme_rows(model, user_readmes, n_probe=8):
+    """
+    The rows of `model.repository_features` whose READMEs the README index
+    of `model` (a `model.RepositoryModel`) finds similar to the user's, or
+    None if there is no index.
+    """
+    if model.readme_index == None:
+        return None
+
+    rows = model.readme_index.candidates(helper.get_readme_vec(user_readmes[0]), n_probe)
+    rows = model.repository_rows[rows]
+    return rows[rows >= 0]
 
-    repo_data = pd.concat([repo_data, user_data], axis=1).fillna(0)
-    user_data = repo_data.loc[:, 'User'].astype(int)
 
-    repo_data = repo_data.drop('User', axis=1)
-    repo_data = repo_data.astype(float).astype(int)
+def candidate_scores(model, user_data, user_readmes, rows, similar_readmes=None):
+    """
+    The scores (lang, topic, readme) of the `rows` of `model` (a
+    `model.RepositoryModel`) for `combine_top`. With `similar_readmes`, as
+    returned by `similar_readme_rows`, only those READMEs are scored and the
+    other candidates are taken as having dissimilar READMEs.
+    """
+    scored = None
+    if similar_readmes is not None:
+        scored = np.isin(rows, similar_readmes)
 
-    return user_data, repo_data
+    return [
+        lang_scores(user_data, model.repository_features, rows),
+        topic_scores(user_data, model.repository_features, rows),
+        readme_scores(user_readmes, model.repository_readmes, rows=model.readme_rows[rows], scored=scored),
+    ]
 
 
-def combine_scores(features, feature_weights):
+def fuse_scores(scores, feature_weights, keep):
+    """
+    The weighted sum of the scores of each feature, NaN for the rows that are
+    not in `keep` or miss any of the scores. See `combine_top`.
+    """
+    weights = np.asarray(feature_weights, dtype=float).ravel()
 
-    final_scores = features.dot(feature_weights)
-    final_scores = pd.Series(np.array(final_scores.values.reshape(final_scores.size,)))
-    final_scores.index = features.index
-    final_scores = helper.normalize(final_scores.sort_values(ascending=False))
+    final_scores = np.multiply(scores[0], weights[0])
+    weighted = np.empty_like(final_scores)
+    for values, weight in zip(scores[1:], weights[1:]):
+        np.multiply(values, weight, out=weighted)
+        final_scores += weighted
+    final_scores[~keep] = np.nan
 
     return final_scores
 
 
+def top_rows(final_scores, k):
+    """
+    The rows of the `k` best of `final_scores`, best first, leaving out NaN.
+    """
+    scored = ~np.isnan(final_scores)
+    k = min(k, int(scored.sum()))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+
+    ranked = np.where(scored, final_scores, -np.inf)
+    top = np.argpartition(-ranked, k - 1)[:k]
+    return top[np.argsort(-ranked[top], kind='mergesort')]
+
+
+def combine_top(repos, scores, feature_weights, keep, k=10):
+    """
+    Combine the scores of each feature into their weighted sum, and return
+    the best `k` repositories.
+
+    The weighted sum is accumulated in one array, the k best are selected
+    with a partial sort in linear time, and only they are sorted. The scores
+    are normalized to [0,1] over all of the candidates.
+
+    Arguments:
+    ==========
+
+    repos: Repository names, one per row
+    scores: Arrays of scores (lang, topic, readme), with a value for each row
+    feature_weights: The weights, as returned by `get_feature_weights`
+    keep: A boolean array, the rows that are candidates for recommendation
+    k: Number of recommendations
+
+    Returns:
+    ========
+
+    result: A Pandas Series of the k best repositories and their scores, best first
+    total: Number of candidates
+    """
+    final_scores = fuse_scores(scores, feature_weights, keep)
+
+    # Repositories missing any of the scores have no final score
+    top = top_rows(final_scores, k)
+    if len(top) == 0:
+        return pd.Series([], dtype=float), int(keep.sum())
+
+    # Normalize to [0,1]
+    top_scores = final_scores[top]
+    minimum, maximum = np.nanmin(final_scores), np.nanmax(final_scores)
+    if maximum - minimum != 0:
+        top_scores = (top_scores - minimum) / float(maximum - minimum)
+
+    return pd.Series(top_scores, index=np.asarray(repos, dtype=object)[top]), int(keep.sum())
+
+
 # TODO: Get weights from a model built on user feedback
 def get_feature_weights(user):
 
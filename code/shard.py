@@ -0,0 +1,294 @@
+'''
+The repository data split into shards, scored by a pool of worker processes.
+
+Each repository belongs to one of the shards, by a hash of its name. Every
+shard is a copy of `data.store` and `data_tok.store` with only its own
+repositories, and its `model.store`, in `output/shards/<shard>/`. A worker
+process per shard loads its shard once; a request is sent to all of them at
+once, each scores its candidates (see `recommend.candidate_rows`) and
+returns its `k` best, and the caller merges those into the overall `k` best.
+The result is the same as scoring the repositories in one process, as the
+web app does without shards.
+
+Usage:
+
+    python code/shard.py --shards 4
+
+Run it again after `vectorize.py` or `preprocess.py` have changed the data;
+the web app starts new worker processes for the new shards.
+'''
+import argparse
+import multiprocessing
+import os
+import shutil
+import threading
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import store
+
+from ann import ReadmeIndex, load_index
+from model import ModelStore, RepositoryModel, data_version, load_readme_model, prepare
+from recommend import (
+    candidate_rows,
+    candidate_scores,
+    fuse_scores,
+    similar_readme_rows,
+    top_rows
+)
+from vectorize import inverted_index
+
+
+def shard_of(repos, n_shards):
+    """Returns the shard of each of `repos`, by a hash of the name that is the same in every process."""
+    return np.array([zlib.crc32(repo.encode('utf-8')) % n_shards for repo in repos], dtype=np.int64)
+
+
+def shard_index(index, rows, n_rows):
+    """
+    The `ann.ReadmeIndex` of only the `rows` of the `n_rows` rows `index` was
+    built from, numbered by their position in `rows`. It has the same lists,
+    so every shard probes the same lists as the whole index would.
+    """
+    local = np.full(n_rows, -1, dtype=np.int64)
+    local[rows] = np.arange(len(rows))
+
+    n_lists = len(index.offsets) - 1
+    lists = np.repeat(np.arange(n_lists), np.diff(index.offsets))
+    found = local[index.order] >= 0
+
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(lists[found], minlength=n_lists))
+    return ReadmeIndex(index.centroids, local[index.order[found]], offsets)
+
+
+def split(base_path, n_shards, directory):
+    """
+    Split `data.store` and `data_tok.store` of `base_path` into `n_shards`
+    shards, saved in `directory`, replacing earlier shards. Returns the number
+    of repositories of each shard.
+    """
+    matrix, repos, columns = store.load(os.path.join(base_path, 'data.store'))
+    readmes = store.load(os.path.join(base_path, 'data_tok.store'))
+    readme_model = load_readme_model(os.path.join(base_path, 'data_tok.store'))
+    readme_index = load_index(os.path.join(base_path, 'data_tok.store'))
+    shards, readme_shards = shard_of(repos, n_shards), shard_of(readmes[1], n_shards)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    sizes = []
+    for shard in range(n_shards):
+        rows, readme_rows = np.flatnonzero(shards == shard), np.flatnonzero(readme_shards == shard)
+        shard_matrix = matrix[rows]
+
+        readme_arrays = {}
+        if readme_model != None:
+            readme_arrays['model'] = np.array(readme_model)
+        if readme_index != None:
+            readme_arrays.update(shard_index(readme_index, readme_rows, len(readmes[1])).arrays())
+
+        store.save(
+            os.path.join(directory, str(shard), 'data.store'),
+            shard_matrix, repos[rows], columns, arrays=inverted_index(shard_matrix))
+        store.save(
+            os.path.join(directory, str(shard), 'data_tok.store'),
+            readmes[0][readme_rows], readmes[1][readme_rows], readmes[2], arrays=readme_arrays)
+        prepare(os.path.join(directory, str(shard)))
+
+        sizes.append(len(rows))
+
+    return sizes
+
+
+# The shard of a worker process, loaded once by `_load_shard`
+_model = None
+
+
+def _load_shard(directory):
+    global _model
+    _model = RepositoryModel(directory)
+
+
+def _count_candidates(user_data, user_readmes, n_probe):
+    """
+    Returns the number of candidates of the shard of this worker, and its
+    number of repositories.
+    """
+    features = _model.repository_features
+    similar_readmes = similar_readme_rows(_model, user_readmes, n_probe)
+    rows = candidate_rows(user_data, features, extra=similar_readmes, min_candidates=0)
+    return len(rows), len(features.repos)
+
+
+def _score_shard(user_data, user_readmes, feature_weights, k, n_probe, all_rows):
+    """
+    Score the candidates of the shard of this worker, or all of its
+    repositories with `all_rows`.
+
+    Returns the names and (not normalized) scores of the `k` best
+    repositories, the lowest and highest score, and the number of candidates.
+    """
+    features = _model.repository_features
+
+    similar_readmes = similar_readme_rows(_model, user_readmes, n_probe)
+    if all_rows:
+        rows = np.arange(len(features.repos))
+    else:
+        rows = candidate_rows(user_data, features, extra=similar_readmes, min_candidates=0)
+
+    scores = candidate_scores(_model, user_data, user_readmes, rows, similar_readmes)
+    keep = features.exclude(user_data[1])[rows]
+    final_scores = fuse_scores(scores, feature_weights, keep)
+
+    top = top_rows(final_scores, k)
+    if len(top) == 0:
+        return [], np.array([]), np.nan, np.nan, int(keep.sum())
+
+    return (list(features.repos[rows[top]]), final_scores[top],
+            np.nanmin(final_scores), np.nanmax(final_scores), int(keep.sum()))
+
+
+def merge_top(partials, k=10):
+    """
+    Merge the results of `_score_shard` of every shard into the overall `k`
+    best, normalized to [0,1], as `combine_top` returns them.
+    """
+    repos = [repo for partial in partials for repo in partial[0]]
+    scores = np.concatenate([partial[1] for partial in partials])
+    total = sum(partial[4] for partial in partials)
+
+    if len(scores) == 0:
+        return pd.Series([], dtype=float), total
+
+    top = np.argsort(-scores, kind='mergesort')[:k]
+    top_scores = scores[top]
+
+    # Normalize to [0,1] over the candidates of all the shards
+    minimum = np.nanmin([partial[2] for partial in partials])
+    maximum = np.nanmax([partial[3] for partial in partials])
+    if maximum - minimum != 0:
+        top_scores = (top_scores - minimum) / float(maximum - minimum)
+
+    return pd.Series(top_scores, index=np.array(repos, dtype=object)[top]), total
+
+
+class ShardPool(object):
+    """
+    A worker process for each shard saved by `split` in `directory`.
+
+    Arguments:
+    ==========
+
+    directory: Directory of the shards
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.directories = sorted(
+            (os.path.join(directory, name) for name in os.listdir(directory) if name.isdigit()),
+            key=lambda path: int(os.path.basename(path)))
+        if len(self.directories) == 0:
+            raise IOError('No shards in `{}`'.format(directory))
+
+        # The directory itself changes when shards are added or removed
+        self.paths = [directory] + [os.path.join(shard, name) for shard in self.directories
+                                    for name in ('data.store', 'data_tok.store', 'model.store')]
+        self.version = data_version(self.paths)
+        self.readme_model = load_readme_model(self.paths[2])
+
+        self._pools = [multiprocessing.Pool(1, initializer=_load_shard, initargs=(shard,))
+                       for shard in self.directories]
+
+    def recommend(self, user_data, user_readmes, feature_weights, k=10, n_probe=8, min_candidates=1000):
+        """
+        Make the `k` best recommendations for a user over all the shards.
+
+        As with `recommend.candidate_rows`, all the repositories are scored
+        if there are fewer than `min_candidates` candidates over all the
+        shards, so the shards are asked for their numbers of candidates first.
+
+        Arguments:
+        ==========
+
+        user_data: The user's vectorized repositories, as returned by `store.load`
+        user_readmes: The user's README vectors, as returned by `store.load`
+        feature_weights: The weights, as returned by `get_feature_weights`
+        k: Number of recommendations
+        n_probe: Number of lists of the README index to search, if the
+                 shards have one, see `ann.ReadmeIndex.candidates`
+        min_candidates: The smallest number of candidates that is used
+
+        Returns:
+        ========
+
+        The same as `combine_top`
+        """
+        all_rows = False
+        if min_candidates > 0:
+            results = [pool.apply_async(_count_candidates, (user_data, user_readmes, n_probe))
+                       for pool in self._pools]
+            counts = [result.get() for result in results]
+            all_rows = sum(count[0] for count in counts) < min(min_candidates, sum(count[1] for count in counts))
+
+        results = [pool.apply_async(_score_shard, (user_data, user_readmes, feature_weights, k, n_probe, all_rows))
+                   for pool in self._pools]
+        return merge_top([result.get() for result in results], k)
+
+    def close(self):
+        """Stops the worker processes."""
+        for pool in self._pools:
+            pool.terminate()
+            pool.join()
+
+
+class ShardStore(ModelStore):
+    """
+    Holds the current `ShardPool` of the shards in `directory`, like
+    `model.ModelStore` does the `RepositoryModel`, and starts a new pool when
+    the shards change. The worker processes of the old pool are stopped
+    after `grace` seconds, when the requests using it have finished.
+
+    Arguments:
+    ==========
+
+    directory: Directory of the shards
+    interval: Seconds between checks for changed shards
+    grace: Seconds before the worker processes of a replaced pool are stopped
+    """
+
+    def __init__(self, directory, interval=2.0, grace=60.0):
+        self.grace = grace
+        super(ShardStore, self).__init__(directory, interval)
+
+    def _load(self):
+        return ShardPool(self.base_path)
+
+    def _retire(self, pool):
+        timer = threading.Timer(self.grace, pool.close)
+        timer.daemon = True
+        timer.start()
+
+
+if __name__ == '__main__':
+
+    print('')
+    print('Shard repository data')
+    print('=====================\n')
+
+    base = os.path.abspath(os.path.dirname(__file__) + '/../output')
+
+    parser = argparse.ArgumentParser(prog='python shard.py')
+    parser.add_argument('--shards', type=int, default=multiprocessing.cpu_count(),
+        help='number of shards (default: number of CPUs)')
+    parser.add_argument('--output', default=os.path.join(base, 'shards'))
+    args = parser.parse_args()
+
+    for shard, size in enumerate(split(base, args.shards, args.output)):
+        print('Shard {}: {} repositories'.format(shard, size))
+
+    print('\nSaved shards to `{}`\n'.format(args.output))
+    print('All done.')
+    print('')
@@ -0,0 +1,270 @@
+'''
+Binary storage for the vectorized and tokenized datasets.
+
+A dataset is stored as a directory (`<name>.store`) of NumPy files:
+
+- `data.npy`, `indices.npy`, `indptr.npy`, `shape.npy`: a CSR matrix with a
+  row for each repository
+- `rows.npy`: repository names (`owner/repo`), one per row
+- `columns.npy`: feature names (languages and topics, or TF-IDF terms), one
+  per column
+- `readmes.bin`, `readme_offsets.npy`, `readme_missing.npy`: the READMEs of
+  a vectorized dataset, concatenated
+- any other arrays of the dataset, e.g. `idf.npy` of the repository TF-IDF
+  model, see `preprocess.py`
+
+`model.store` holds only arrays, the repository data prepared for serving,
+see `model.py`.
+
+All of these can be memory-mapped, so loading a dataset does not parse or
+copy it. Run `python code/store.py file.csv ...` to convert CSV-files written
+by earlier versions of `vectorize.py` and `preprocess.py`.
+'''
+import ast
+import os
+import shutil
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+
+def save(directory, matrix, rows, columns, readmes=None, arrays=None):
+    """
+    Save a dataset to `directory`, replacing the previous one.
+
+    Arguments:
+    ==========
+
+    directory: Directory to save to, by convention `<name>.store`
+    matrix: A scipy.sparse matrix with a row for each repository
+    rows: Repository names, one per row
+    columns: Feature names, one per column
+    readmes: READMEs (bytes, or None), one per row; optional
+    arrays: A dict of other arrays to save, by name; optional
+    """
+    matrix = sparse.csr_matrix(matrix)
+
+    # Write everything to a temporary directory, and only then replace the
+    # previous version, so that readers never see a half-written dataset
+    tmp = _make_tmp(directory)
+
+    np.save(os.path.join(tmp, 'data.npy'), matrix.data)
+    np.save(os.path.join(tmp, 'indices.npy'), matrix.indices)
+    np.save(os.path.join(tmp, 'indptr.npy'), matrix.indptr)
+    np.save(os.path.join(tmp, 'shape.npy'), np.array(matrix.shape, dtype=np.int64))
+    np.save(os.path.join(tmp, 'rows.npy'), np.array(rows, dtype=str))
+    np.save(os.path.join(tmp, 'columns.npy'), np.array(columns, dtype=str))
+
+    if readmes != None:
+        offsets = np.zeros(len(readmes) + 1, dtype=np.int64)
+        with open(os.path.join(tmp, 'readmes.bin'), 'wb') as f:
+            for idx, readme in enumerate(readmes):
+                if readme != None:
+                    f.write(readme)
+                offsets[idx + 1] = offsets[idx] + (len(readme) if readme != None else 0)
+        np.save(os.path.join(tmp, 'readme_offsets.npy'), offsets)
+        np.save(os.path.join(tmp, 'readme_missing.npy'), np.array([r == None for r in readmes], dtype=bool))
+
+    for name, array in (arrays or {}).items():
+        np.save(os.path.join(tmp, name + '.npy'), np.asarray(array))
+
+    _replace(tmp, directory)
+
+
+def save_arrays(directory, arrays):
+    """
+    Save a dict of arrays, by name, to `directory`, replacing the previous
+    ones. Load them with `load_array`.
+    """
+    tmp = _make_tmp(directory)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), np.asarray(array))
+
+    _replace(tmp, directory)
+
+
+def _suffix():
+    # Unique to the process and thread, so that concurrent saves of the same
+    # directory never write to or remove each other's files
+    return '.{}.{}'.format(os.getpid(), threading.get_ident())
+
+
+def _make_tmp(directory):
+    tmp = directory.rstrip('/') + '.tmp' + _suffix()
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    return tmp
+
+
+def _replace(tmp, directory):
+    old = directory.rstrip('/') + '.old' + _suffix()
+
+    # Another save may put its version in place between the two renames, in
+    # which case that one is moved aside, too; the last save wins
+    while True:
+        try:
+            os.rename(directory, old)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(tmp, directory)
+            break
+        except OSError:
+            if not os.path.exists(directory):
+                raise
+            if os.path.exists(old):
+                shutil.rmtree(old)
+
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+
+def load(directory, mmap=True):
+    """
+    Load a dataset saved with `save`.
+
+    Arguments:
+    ==========
+
+    directory: Directory of the dataset
+    mmap: Whether to memory-map the arrays instead of reading them to memory
+
+    Returns:
+    ========
+
+    matrix: A scipy.sparse CSR matrix with a row for each repository
+    rows: An array of repository names, one per row
+    columns: An array of feature names, one per column
+    """
+    mode = 'r' if mmap else None
+
+    def array(name):
+        return np.load(os.path.join(directory, name), mmap_mode=mode)
+
+    shape = tuple(int(x) for x in array('shape.npy'))
+    matrix = sparse.csr_matrix(
+        (array('data.npy'), array('indices.npy'), array('indptr.npy')), shape=shape, copy=False)
+
+    return matrix, array('rows.npy'), array('columns.npy')
+
+
+def load_array(directory, name, mmap=True):
+    """Load an array saved with `save(..., arrays={name: array})`, or None if there is none."""
+    path = os.path.join(directory, name + '.npy')
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+
+def load_readmes(directory):
+    """Load the READMEs of a dataset as a list of bytes (or None)."""
+    if not os.path.exists(os.path.join(directory, 'readmes.bin')):
+        return None
+
+    offsets = np.load(os.path.join(directory, 'readme_offsets.npy'))
+    missing = np.load(os.path.join(directory, 'readme_missing.npy'))
+    with open(os.path.join(directory, 'readmes.bin'), 'rb') as f:
+        content = f.read()
+
+    return [None if missing[idx] else content[offsets[idx]:offsets[idx + 1]]
+            for idx in range(len(missing))]
+
+
+def to_frame(matrix, repos, features, readmes):
+    """
+    Convert a vectorized dataset to a DataFrame with a column for each
+    repository and a row for each feature and the README, the layout of
+    `vectorize.vectorize`. Features a repository does not have, and missing
+    READMEs, are NaN.
+    """
+    repos = np.asarray(repos, dtype=object)
+    readmes = [np.nan if readme == None else readme for readme in readmes]
+    features = np.asarray(features, dtype=object)
+
+    dense = np.full((len(features), len(repos)), np.nan)
+    coo = matrix.tocoo()
+    dense[coo.col, coo.row] = coo.data
+
+    df = pd.DataFrame(dense, index=features, columns=repos)
+    df = pd.concat([df, pd.DataFrame([readmes], index=['readme'], columns=repos)])
+
+    return df.sort_index()
+
+
+def load_frame(directory):
+    """
+    Load a dataset as a DataFrame in the layout of the corresponding
+    CSV-file: vectorized datasets as in `to_frame`, tokenized ones with a row
+    for each repository and a column for each term.
+    """
+    matrix, rows, columns = load(directory)
+    readmes = load_readmes(directory)
+
+    if readmes != None:
+        return to_frame(matrix, rows, columns, readmes)
+
+    return pd.DataFrame(
+        matrix.toarray(),
+        index=np.asarray(rows, dtype=object),
+        columns=np.asarray(columns, dtype=object))
+
+
+def from_csv(csv_file):
+    """
+    Read a CSV-file written by an earlier version of `vectorize.py` (a
+    column for each repository, with a `readme` row) or `preprocess.py` (a
+    row for each repository).
+
+    Returns:
+    ========
+
+    matrix, rows, columns, readmes as taken by `save`; readmes is None for
+    tokenized datasets.
+    """
+    df = pd.read_csv(csv_file, index_col=0, low_memory=False)
+
+    if 'readme' not in df.index:
+        return sparse.csr_matrix(df.values.astype(float)), df.index.values, df.columns.values, None
+
+    readmes = []
+    for readme in df.loc['readme']:
+        if type(readme) != str:
+            readmes.append(None)
+        elif readme.startswith("b'") or readme.startswith('b"'):
+            # vectorize.py wrote the decoded READMEs as bytes literals
+            readmes.append(ast.literal_eval(readme))
+        else:
+            readmes.append(readme.encode('utf-8'))
+
+    # Missing features are NaN; stored zeros (`l_unknown`) are kept
+    values = df.drop('readme', axis='index').values.astype(float).T
+    rows, cols = np.nonzero(~np.isnan(values))
+    matrix = sparse.csr_matrix((values[rows, cols], (rows, cols)), shape=values.shape)
+
+    return matrix, df.columns.values, df.index.drop('readme').values, readmes
+
+
+if __name__ == '__main__':
+
+    print('')
+    print('CSV to binary dataset converter')
+    print('===============================\n')
+
+    if len(sys.argv) < 2:
+        print('Usage:\n\tpython store.py file.csv [file.csv ...]\n')
+        sys.exit(0)
+
+    for csv_file in sys.argv[1:]:
+        to_dir = os.path.splitext(csv_file)[0] + '.store'
+        print('Converting `{}` to `{}`'.format(csv_file, to_dir))
+        save(to_dir, *from_csv(csv_file))
+
+    print('')
+    print('All done.')
+    print('')
@@ -1,11 +1,14 @@
 '''
 Github user profile extractor.
 '''
+import argparse
 import json
 import sys
 import os
 
 from helper import (
+    API_URL,
+    USER_NOT_FOUND,
     get_languages,
     get_license,
     get_readme,
@@ -13,11 +16,14 @@ from helper import (
     get_user_repos,
     is_contributor,
     process_repo,
+    process_repos,
     rate_limit,
+    request_stats,
     resolve_url
 )
+from graphql import process_repos_graphql
 
-def get_userdata(user, output=False):
+def get_userdata(user, output=False, workers=1, graphql=False):
 
     # Get all user repos: 1) own repos (either fork or non-fork), 2) starred
     # repos, 3) followed repos (subscriptions)
@@ -30,11 +36,11 @@ def get_userdata(user, output=False):
         print('')
 
     # Extract the data from repos
-    for idx, repo in enumerate(repos):
+    process = process_repos_graphql if graphql else process_repos
+    for idx, entry in enumerate(process(repos, user, workers)):
 
         if output == True:
-            print('Processing repo {} of {}'.format(idx + 1, len(repos)))
-        entry = process_repo(repo, user)
+            print('Processed repo {} of {}'.format(idx + 1, len(repos)))
         if entry['valid'] == True:
             data.append(entry)
         else:
@@ -48,18 +54,35 @@ if __name__ == '__main__':
     print('Github user profile extractor')
     print('=============================\n')
 
-    if len(sys.argv) != 2:
-        print('Usage:\n\tpython user.py github-user-name\n')
-        sys.exit(0)
+    parser = argparse.ArgumentParser(prog='python user.py')
+    parser.add_argument('user', help='github user name')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of repositories processed concurrently (default: 1)')
+    parser.add_argument('--graphql', action='store_true',
+        help='retrieve repositories in batches with the GraphQL API')
+    args = parser.parse_args()
 
-    user = sys.argv[1]
+    user = args.user
+
+    if os.getenv('GITHUB') == None:
+        print('Environment variable GITHUB not found.\nCreate a personal access token on Github and store it to an environment variable.\n')
+        sys.exit(1)
 
     rate_limit() # Inform about rate limits
 
     print('')
     print('Query: {}'.format(user))
 
-    data, _ = get_userdata(user=user, output=True)
+    # Without the user, the repositories would be empty rather than missing
+    profile, response = resolve_url(API_URL + '/users/{}'.format(user))
+    if profile == None:
+        print('User {} not found.\n'.format(user))
+        sys.exit(USER_NOT_FOUND)
+    if response.status_code not in (200, 304):
+        print('Failed to look up user {}: {}\n'.format(user, profile.get('message', response.status_code)))
+        sys.exit(1)
+
+    data, _ = get_userdata(user=user, output=True, workers=args.workers, graphql=args.graphql)
 
     print('')
     print('Found {} repositories related to user {}'.format(len(data), user))
@@ -79,5 +102,7 @@ if __name__ == '__main__':
     with open(to_file, 'w') as f:
         json.dump(data, f, indent=2)
 
+    print(request_stats())
+    print('')
     print('All done.')
     print('')
@@ -2,53 +2,173 @@
 Vectorizing data retreved from Github.
 '''
 
-import sys
+import argparse
 import os
 import json
 import pandas as pd
 import numpy as np
 import base64
 
-def vectorize(data, output_file=None):
-
-    if type(data) != pd.DataFrame:
-        raise TypeError('Input for `vectorize` must be a Pandas DataFrame.')
-
-    data = data[['owner', 'repo', 'languages', 'topics', 'readme']]
-    
-    df = pd.DataFrame()
-    for idx, row in data.iterrows():
-
-        # Topics
-        topics = ['t_' + topic.lower() for topic in row[3]]
-        topics = pd.DataFrame(np.ones(len(topics)), index=topics)
-
-        # Languages
-        languages = row[2]
+from array import array
+from scipy import sparse
+
+import store
+from store import to_frame
+
+def read_entries(input_file):
+    """
+    Read the entries retrieved by `data.py` or `user.py` one at a time.
+
+    Files ending with `.jsonl` are streamed line by line, so that the whole
+    dataset never needs to be in memory. Other files are read as a JSON list.
+    """
+    if input_file.endswith('.jsonl'):
+        with open(input_file) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(input_file) as f:
+            for entry in json.load(f):
+                yield entry
+
+def index_entries(input_file):
+    """
+    Index the entries of a `.jsonl` file by `owner/repo`. The index tells
+    when each repository was last changed and where its entry starts in the
+    file: `{"owner/repo": (pushed_at, updated_at, offset)}`.
+    """
+    index = {}
+    offset = 0
+    with open(input_file, 'rb') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line.decode('utf-8'))
+                index['{}/{}'.format(entry['owner'], entry['repo'])] = (
+                    entry.get('pushed_at'), entry.get('updated_at'), offset)
+            offset += len(line)
+    return index
+
+def count_entries(input_file):
+    """Count the complete entries of a `.jsonl` file, 0 if it does not exist."""
+    if not os.path.exists(input_file):
+        return 0
+    with open(input_file, 'rb') as f:
+        return sum(1 for line in f if line.endswith(b'\n') and line.strip())
+
+def vectorize_sparse(entries):
+    """
+    Vectorize repositories in one pass over the entries.
+
+    Languages (`l_*`, lines of code) and topics (`t_*`, 1.0) of all the
+    repositories are collected into one sparse matrix, with a row for each
+    repository and a column for each language and topic. Repositories with
+    no known languages get `l_unknown` with an explicitly stored 0, as in
+    the DataFrame returned by `vectorize`.
+
+    Arguments:
+    ==========
+
+    entries: An iterable of entries retrieved by `data.py` or `user.py`, e.g.
+             `read_entries(input_file)`. Entries that are not valid are skipped.
+
+    Returns:
+    ========
+
+    matrix: A scipy.sparse CSR matrix of shape (repositories, features)
+    repos: An array of repository names (`owner/repo`), one per row
+    features: An array of sorted feature names, one per column
+    readmes: A list of decoded READMEs (bytes, or None), one per row
+    """
+    vocabulary = {}
+    repos, readmes = [], []
+    rows, cols, values = array('q'), array('q'), array('d')
+
+    for entry in entries:
+
+        if entry.get('valid') == False:
+            continue
+
+        row = len(repos)
+        repos.append(entry['owner'] + '/' + entry['repo'])
 
         # Handle the case when there's no known languages informed
+        languages = entry['languages']
         if not languages:
             languages = {'Unknown': 0}
 
-        # Create languages dataframe
-        languages = pd.DataFrame.from_dict(languages, orient='index')
-        languages.index = 'l_' + languages.index.str.lower()
+        for language, loc in languages.items():
+            rows.append(row)
+            cols.append(vocabulary.setdefault('l_' + language.lower(), len(vocabulary)))
+            values.append(loc)
+
+        for topic in entry['topics']:
+            rows.append(row)
+            cols.append(vocabulary.setdefault('t_' + topic.lower(), len(vocabulary)))
+            values.append(1.0)
 
         # READMEs
-        if 'encoding' in row['readme'] and row['readme']['encoding'] == 'base64':
-            readme = base64.b64decode(row['readme']['content'])
+        readme = entry.get('readme') or {}
+        if 'encoding' in readme and readme['encoding'] == 'base64':
+            readmes.append(base64.b64decode(readme['content']))
         else:
-            readme = None
-        readme = pd.DataFrame(data=[readme], index=['readme'])
+            readmes.append(None)
+
+    # Sort the features, mapping the columns to the sorted order
+    features = np.array(sorted(vocabulary), dtype=object)
+    order = np.empty(len(vocabulary), dtype=np.int64)
+    order[[vocabulary[feature] for feature in features]] = np.arange(len(features))
+
+    matrix = sparse.coo_matrix(
+        (np.asarray(values, dtype=np.float64),
+         (np.asarray(rows, dtype=np.int64), order[np.asarray(cols, dtype=np.int64)])),
+        shape=(len(repos), len(features))).tocsr()
+
+    return matrix, np.array(repos, dtype=object), features, readmes
+
+def merge_vectorized(first, second):
+    """
+    Combine two outputs of `vectorize_sparse` into one, e.g. an existing
+    dataset and the repositories changed since. The features of the result
+    are the sorted union of the features of both.
+    """
+    features = np.union1d(first[2], second[2]).astype(object)
 
-        # Create one entry
-        entry = pd.concat([languages, topics, readme])
-        entry.columns = [row[0] + '/' + row[1]]
-        # entry = entry.iloc[:, 0] # INKA REMOVED
+    matrices = []
+    for matrix, _, columns, _ in (first, second):
+        coo = matrix.tocoo()
+        columns = np.searchsorted(features, np.asarray(columns, dtype=object))
+        matrices.append(sparse.csr_matrix(
+            (coo.data, (coo.row, columns[coo.col])), shape=(matrix.shape[0], len(features))))
 
-        df = pd.concat([df, entry], axis=1)
+    repos = np.concatenate([np.asarray(first[1], dtype=object), np.asarray(second[1], dtype=object)])
 
-    return df
+    return sparse.vstack(matrices).tocsr(), repos, features, list(first[3]) + list(second[3])
+
+def vectorize(data, output_file=None):
+
+    if type(data) != pd.DataFrame:
+        raise TypeError('Input for `vectorize` must be a Pandas DataFrame.')
+
+    return to_frame(*vectorize_sparse(data.to_dict('records')))
+
+def inverted_index(matrix):
+    """
+    Build an inverted index of a vectorized dataset: for each feature, the
+    rows of the repositories that have it (a non-zero value), in order.
+
+    Returns:
+    ========
+
+    A dict of arrays to save with the dataset: the posting list of the feature
+    in column `i` is `postings_rows[postings_indptr[i]:postings_indptr[i + 1]]`
+    """
+    postings = sparse.csc_matrix(sparse.csr_matrix(matrix) != 0)
+    postings.sort_indices()
+    return {
+        'postings_indptr': postings.indptr.astype(np.int64),
+        'postings_rows': postings.indices.astype(np.int64),
+    }
 
 if __name__ == '__main__':
     
@@ -56,29 +176,66 @@ if __name__ == '__main__':
     print('Github data vectorizer')
     print('======================\n')
 
-    if len(sys.argv) != 2:
-        print('Usage:\n\tpython vectorize.py input.json\n')
-        sys.exit(0)
-
-    input_file = sys.argv[1]
-    print('Reading `{}` as input file\n'.format(input_file))
-    data = pd.read_json(input_file)
+    parser = argparse.ArgumentParser(prog='python vectorize.py')
+    parser.add_argument('input_file', help='input.json or input.jsonl')
+    parser.add_argument('--changes',
+        help='changes file written by `data.py --refresh`; only the changed '
+             'repositories are vectorized and the existing output is updated')
+    parser.add_argument('--csv', action='store_true',
+        help='also save the output as CSV, with a column for each repository')
+    args = parser.parse_args()
 
-    df = vectorize(data)
+    input_file = args.input_file
 
     # Get the directory of current script (code/vectorize.py)
     base = os.path.dirname(__file__)
 
     # If called like this: python code/vectorize.py input.json, takes only the input
-    # filename, input.json at this example.
-    input_file = os.path.basename(input_file)
+    # filename, input.json at this example. Create output filenames (absolute paths)
+    name = os.path.basename(input_file).split('.')[0]
+    to_dir = os.path.abspath('{}/../output/{}.store'.format(base, name))
+    to_file = os.path.abspath('{}/../output/{}.csv'.format(base, name))
+
+    print('Reading `{}` as input file\n'.format(input_file))
 
-    # Create output filename (absolute path)
-    to_file = os.path.abspath('{}/../output/{}.csv'.format(base, input_file.split('.')[0]))
+    if args.changes == None:
+        vectorized = vectorize_sparse(read_entries(input_file))
+    else:
+        with open(args.changes) as f:
+            changes = json.load(f)
+        changed = set(changes['changed'])
+
+        print('Updating {} changed and {} removed repositories in `{}`\n'.format(
+            len(changes['changed']), len(changes['removed']), to_dir))
+
+        # Drop the removed and changed repositories from the existing output
+        # and add the changed ones vectorized again
+        matrix, repos, features = store.load(to_dir, mmap=False)
+        readmes = store.load_readmes(to_dir)
+        keep = ~np.isin(repos, changes['removed'] + changes['changed'])
+
+        vectorized = merge_vectorized(
+            (matrix[keep], repos[keep], features, [r for r, k in zip(readmes, keep) if k]),
+            vectorize_sparse(entry for entry in read_entries(input_file)
+                if '{}/{}'.format(entry['owner'], entry['repo']) in changed))
+
+        # Drop the features no repository has any more
+        matrix, repos, features, readmes = vectorized
+        used = matrix.getnnz(axis=0) > 0
+        vectorized = matrix[:, used], repos, features[used], readmes
+
+    print('Saving data to `{}`\n'.format(to_dir))
+    print('Saved data has shape of {}\n'.format(vectorized[0].shape))
+    store.save(to_dir, *vectorized, arrays=inverted_index(vectorized[0]))
+
+    # The changes have been applied, so the next refresh starts a new list
+    if args.changes != None:
+        os.replace(args.changes, args.changes + '.applied')
+
+    if args.csv:
+        print('Saving data to `{}`\n'.format(to_file))
+        with open(to_file, 'w') as f:
+            to_frame(*vectorized).to_csv(f)
 
-    print('Saving data to `{}`\n'.format(to_file))
-    print('Saved data has shape of {}\n'.format(df.shape))
-    with open(to_file, 'w') as f:
-        df.to_csv(f)
     print('All done.')
     print('')
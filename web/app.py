@@ -1,19 +1,29 @@
 import sys
 import os
-import pandas as pd
+import math
+import time
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/../code'))
 
+import pandas as pd
+
+import store
+
+from cache import RecommendationCache
+from ingest import IngestQueue, is_username
+from model import ModelStore, data_version, is_same_model
 from recommend import (
-    combine_scores,
-    recommend_lang,
-    recommend_readme,
-    recommend_topic,
-    get_feature_weights
+    candidate_rows,
+    candidate_scores,
+    combine_top,
+    get_feature_weights,
+    similar_readme_rows
 )
+from shard import ShardStore
 
 from flask import (
     Flask,
+    jsonify,
     render_template,
     request,
     redirect,
@@ -22,6 +32,84 @@ from flask import (
 
 app = Flask(__name__)
 
+# Basepath to where the data files are located
+base_path = os.path.abspath(os.path.dirname(__file__) + '/../output')
+
+# Number of lists searched when the README index exists; more lists find
+# more of the most similar READMEs, but take longer
+ann_probes = int(os.getenv('RECOMMENDER_ANN_PROBES', 8))
+
+# Only repositories sharing a language or topic with the user (or with a
+# similar README, if the README index exists) are scored, unless there are
+# fewer of them than this
+min_candidates = int(os.getenv('RECOMMENDER_MIN_CANDIDATES', 1000))
+
+# With RECOMMENDER_SHARDS set to the directory written by `shard.py`, all
+# the repositories are scored by a worker process per shard, started again
+# when the shards change. Otherwise, the repository data is loaded once and
+# reloaded when the files change, so that requests only need to load the
+# user's own data
+shards, models = None, None
+if os.getenv('RECOMMENDER_SHARDS'):
+    shards = ShardStore(os.getenv('RECOMMENDER_SHARDS'))
+else:
+    models = ModelStore(base_path)
+
+# Recommendations already computed, by user and the versions of the user's
+# and the repository data files; RECOMMENDER_CACHE_FILE also keeps them on
+# disk across restarts, and a size of 0 turns the cache off
+recommendation_cache = RecommendationCache(
+    int(os.getenv('RECOMMENDER_CACHE_SIZE', 1024)),
+    os.getenv('RECOMMENDER_CACHE_FILE'))
+
+# Users without data are fetched and prepared in the background, at most
+# RECOMMENDER_INGEST_JOBS at a time (0 turns this off, and such users get
+# 404 Not found), RECOMMENDER_INGEST_WORKERS of them at once
+ingest_jobs = int(os.getenv('RECOMMENDER_INGEST_JOBS', 4))
+ingest_queue = None
+if ingest_jobs > 0:
+    ingest_queue = IngestQueue(
+        os.path.abspath(os.path.dirname(__file__) + '/..'),
+        max_jobs=ingest_jobs,
+        workers=int(os.getenv('RECOMMENDER_INGEST_WORKERS', 1)))
+
+def user_exists(user):
+    return (os.path.exists('{}/{}.store'.format(base_path, user))
+            and os.path.exists('{}/{}_tok.store'.format(base_path, user)))
+
+def recommend_from_model(model, user_data, user_readmes, feature_weights):
+    repository_features = model.repository_features
+
+    # The candidates for recommendation
+    similar_readmes = similar_readme_rows(model, user_readmes, ann_probes)
+    rows = candidate_rows(user_data, repository_features, extra=similar_readmes, min_candidates=min_candidates)
+
+    # Calculating similarities per feature for the candidates
+    scores = candidate_scores(model, user_data, user_readmes, rows, similar_readmes)
+
+    # Calculate final recommendations, leaving out the user's own repositories
+    return combine_top(
+        repository_features.repos[rows],
+        scores,
+        feature_weights,
+        repository_features.exclude(user_data[1])[rows],
+        k=10)
+
+def show_job(job, user):
+    """The page for the ingestion `job` of `user`, as returned by `IngestQueue.submit`."""
+    if job == None:
+        return render_template('pending.html', job=None, username=user), 503
+
+    # A failed job is only run again from `retry_at` on
+    if job['status'] == 'failed':
+        retry_after = 0
+        if job.get('retry_at') != None:
+            retry_after = max(0, int(math.ceil(job['retry_at'] - time.time())))
+        return (render_template('pending.html', job=job, username=user, retry_minutes=int(math.ceil(retry_after / 60.0))),
+                503, {'Retry-After': str(retry_after)})
+
+    return render_template('pending.html', job=job, username=user), 202
+
 @app.route('/404')
 def not_found():
     return render_template('404.html')
@@ -30,46 +118,96 @@ def not_found():
 def index():
     return render_template('input.html')
 
+@app.route('/cache-stats')
+def cache_stats():
+    return jsonify(recommendation_cache.counters())
+
+@app.route('/ingest-status/<user>')
+def ingest_status(user):
+    job = None
+    if ingest_queue != None and is_username(user):
+        job = ingest_queue.status(user)
+
+    if job == None:
+        if is_username(user) and user_exists(user):
+            return jsonify({'user': user, 'status': 'done'})
+        return jsonify({'user': user, 'status': 'unknown'}), 404
+
+    return jsonify(job)
+
 @app.route('/recommend-software', methods=['POST'])
 def recommend_software():
 
     user = request.form['username']
 
-    # Basepath to where the data files are located
-    base_path = os.path.abspath(os.path.dirname(__file__) + '/../output')
-
     user_data = None
-    user_file = os.path.abspath(base_path + '/{}.csv'.format(user))
-
-    # If data file for user doesn't exist, redirect to 404 Not found. Otherwise
-    # just read the data.
-    if os.path.exists(user_file):
-        user_data = pd.read_csv(user_file, index_col=0)
+    user_store = os.path.abspath(base_path + '/{}.store'.format(user))
+
+    # If data for user doesn't exist, or is still being prepared, fetch and
+    # prepare it in the background and show a page that waits for it. If
+    # that is turned off, redirect to 404 Not found. Otherwise just load the
+    # data.
+    if ingest_queue != None and is_username(user):
+        job = ingest_queue.status(user)
+        if job != None and job['status'] in ('queued', 'running'):
+            return render_template('pending.html', job=job, username=user)
+
+    if user_exists(user):
+        user_data = store.load(user_store)
+    elif ingest_queue != None and is_username(user):
+        return show_job(ingest_queue.submit(user), user)
     else:
         return redirect(url_for('not_found'), 302)
 
-    repository_file = os.path.abspath(base_path + '/data.csv')
-
-    # Reading the repository-data
-    repository_data = pd.read_csv(repository_file, index_col=0, low_memory=False)
-
-    # Reading the preprocessed README-values
-    user_readmes = pd.read_csv("{}/{}_tok.csv".format(base_path, user), index_col=0, low_memory=False)
-    repository_readmes = pd.read_csv("{}/data_tok.csv".format(base_path), index_col=0, low_memory=False)
-
-    # Calculating similarities per feature
-    similarities_lang = recommend_lang(user_data, repository_data)
-    similarities_topic = recommend_topic(user_data, repository_data, user)
-    similarities_readme = recommend_readme(user_readmes, repository_readmes)
+    # The repository-data, loaded once for all requests
+    if shards != None:
+        pool = shards.current()
+        version, readme_model = pool.version, pool.readme_model
+    else:
+        model = models.current()
+        version, readme_model = model.version, model.readme_model
+
+    # README vectors transformed with another TF-IDF model than the
+    # repositories' (e.g. fitted again on a new dataset) cannot be compared
+    # with them, so they are transformed again first
+    user_tok_store = "{}/{}_tok.store".format(base_path, user)
+    if not is_same_model(user_tok_store, readme_model):
+        if ingest_queue == None or not is_username(user):
+            return redirect(url_for('not_found'), 302)
+        return show_job(ingest_queue.submit(user, first_step='preprocess'), user)
+
+    # Recommendations computed before from the same files
+    key = recommendation_cache.key(
+        user, [data_version([user_store, user_tok_store]), version], [ann_probes, min_candidates])
+    cached = recommendation_cache.get(key)
+    if cached != None:
+        recommendations = pd.Series(
+            [score for _, score in cached['recommendations']],
+            index=[repo for repo, _ in cached['recommendations']],
+            dtype=float)
+        return render_template(
+            'recommendations.html',
+            recommendations=recommendations,
+            total=cached['total'],
+            username=user)
+
+    # Loading the preprocessed README-values
+    user_readmes = store.load(user_tok_store)
 
-    # Calculate final recommendations
-    features = pd.concat((similarities_lang, similarities_topic, similarities_readme), axis=1)
     feature_weights = get_feature_weights(user)
-    recommendations = combine_scores(features, feature_weights)
-    recommendations = recommendations.head(10)
+    if shards != None:
+        recommendations, total = pool.recommend(
+            user_data, user_readmes, feature_weights, k=10, n_probe=ann_probes, min_candidates=min_candidates)
+    else:
+        recommendations, total = recommend_from_model(model, user_data, user_readmes, feature_weights)
+
+    recommendation_cache.put(key, {
+        'recommendations': [[repo, float(score)] for repo, score in recommendations.items()],
+        'total': int(total),
+    })
 
     return render_template(
         'recommendations.html',
-        recommendations=recommendations.head(10),
-        total=recommendations.shape[0],
+        recommendations=recommendations,
+        total=total,
         username=user)
@@ -0,0 +1,107 @@
+'''
+Serves the web app with several worker processes sharing one copy of the
+repository data.
+
+Usage:
+
+    python web/serve.py --workers 4 --port 5000
+
+The repository data is prepared (see `code/model.py`) and loaded before the
+worker processes are forked, so the workers start with the model already
+loaded and share its memory with each other instead of each loading a copy.
+The model arrays are memory-mapped from `model.store`, so the data loaded by
+a worker after a change of the files is shared through the page cache, too.
+
+With `--report-memory N`, the resident and private memory of each worker is
+printed every N seconds; the private memory of a worker should stay about
+the same when more workers are added.
+'''
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/../code'))
+
+import argparse
+import gc
+import signal
+import socket
+import time
+
+from model import data_version, load_prepared, memory_usage, prepare
+
+
+def fork_workers(listener, app, n_workers):
+    """Forks `n_workers` processes serving `app` on the `listener` socket, and returns their ids."""
+    from werkzeug.serving import make_server
+
+    pids = []
+    for _ in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            host, port = listener.getsockname()[:2]
+            try:
+                make_server(host, port, app, fd=listener.fileno()).serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    return pids
+
+
+if __name__ == '__main__':
+
+    base_path = os.path.abspath(os.path.dirname(__file__) + '/../output')
+
+    parser = argparse.ArgumentParser(prog='python serve.py')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--report-memory', type=float, default=0, metavar='N',
+        help='print the memory of the workers every N seconds')
+    args = parser.parse_args()
+
+    # Prepare the repository data if it has changed, and load it before
+    # forking the workers
+    paths = [os.path.join(base_path, name) for name in ('data.store', 'data_tok.store', 'model.store')]
+    if load_prepared(paths[2], data_version(paths[:2])) == None:
+        print('Preparing the repository data')
+        prepare(base_path)
+
+    import app as webapp
+
+    if webapp.shards != None:
+        print('RECOMMENDER_SHARDS is not supported with several workers, run the app with `./run.sh`.')
+        sys.exit(1)
+    webapp.models.current()
+
+    # Keep the garbage collector of the workers from touching, and so
+    # copying, the objects loaded before forking (Python 3.7 and later)
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(128)
+
+    pids = fork_workers(listener, webapp.app, args.workers)
+    print('Serving on http://{}:{}/ with {} workers'.format(args.host, args.port, len(pids)))
+
+    def stop(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while True:
+        if args.report_memory > 0:
+            time.sleep(args.report_memory)
+            for pid in pids:
+                usage = memory_usage(pid)
+                print('Worker {}: {:.1f} MB resident, {:.1f} MB proportional, {:.1f} MB private'.format(
+                    pid, usage['rss'] / 1e6, usage['pss'] / 1e6, usage['private'] / 1e6))
+        else:
+            signal.pause()